@@ -5,7 +5,7 @@ _mritool()
     cur="${COMP_WORDS[COMP_CWORD]}"
 
     if [ $COMP_CWORD -eq 1 ]; then
-        COMPREPLY=( $( compgen -W ' pull sync-exams complete pfile-headers list-inprocess list-exams list-series check help' -- $cur) )
+        COMPREPLY=( $( compgen -W ' pull sync-exams complete pfile-headers list-inprocess gc list-exams export-headers list-series check help' -- $cur) )
     else
         case ${COMP_WORDS[1]} in
             pull)
@@ -22,9 +22,15 @@ _mritool()
         ;;
             list-inprocess)
             _mritool_list-inprocess
+        ;;
+            gc)
+            _mritool_gc
         ;;
             list-exams)
             _mritool_list-exams
+        ;;
+            export-headers)
+            _mritool_export-headers
         ;;
             list-series)
             _mritool_list-series
@@ -46,7 +52,7 @@ _mritool_pull()
     cur="${COMP_WORDS[COMP_CWORD]}"
 
     if [ $COMP_CWORD -ge 2 ]; then
-        COMPREPLY=( $( compgen -fW '-o= --bare ' -- $cur) )
+        COMPREPLY=( $( compgen -fW '-b= -d= -o= --bare -j= --process= --process-jobs= ' -- $cur) )
     fi
 }
 
@@ -56,7 +62,7 @@ _mritool_sync-exams()
     cur="${COMP_WORDS[COMP_CWORD]}"
 
     if [ $COMP_CWORD -ge 2 ]; then
-        COMPREPLY=( $( compgen -W ' ' -- $cur) )
+        COMPREPLY=( $( compgen -W '-e= --order= --limits= --state-dir= --process= --process-jobs= ' -- $cur) )
     fi
 }
 
@@ -66,7 +72,7 @@ _mritool_complete()
     cur="${COMP_WORDS[COMP_CWORD]}"
 
     if [ $COMP_CWORD -ge 2 ]; then
-        COMPREPLY=( $( compgen -fW ' ' -- $cur) )
+        COMPREPLY=( $( compgen -fW '--deep ' -- $cur) )
     fi
 }
 
@@ -90,6 +96,16 @@ _mritool_list-inprocess()
     fi
 }
 
+_mritool_gc()
+{
+    local cur
+    cur="${COMP_WORDS[COMP_CWORD]}"
+
+    if [ $COMP_CWORD -ge 2 ]; then
+        COMPREPLY=( $( compgen -W ' ' -- $cur) )
+    fi
+}
+
 _mritool_list-exams()
 {
     local cur
@@ -100,6 +116,16 @@ _mritool_list-exams()
     fi
 }
 
+_mritool_export-headers()
+{
+    local cur
+    cur="${COMP_WORDS[COMP_CWORD]}"
+
+    if [ $COMP_CWORD -ge 2 ]; then
+        COMPREPLY=( $( compgen -fW '-j= --all ' -- $cur) )
+    fi
+}
+
 _mritool_list-series()
 {
     local cur
@@ -116,7 +142,7 @@ _mritool_check()
     cur="${COMP_WORDS[COMP_CWORD]}"
 
     if [ $COMP_CWORD -ge 2 ]; then
-        COMPREPLY=( $( compgen -fW ' ' -- $cur) )
+        COMPREPLY=( $( compgen -fW '--deep ' -- $cur) )
     fi
 }
 
@@ -130,4 +156,4 @@ _mritool_help()
     fi
 }
 
-complete -F _mritool mritool
\ No newline at end of file
+complete -o bashdefault -o default -o filenames -F _mritool mritool
\ No newline at end of file
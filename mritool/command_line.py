@@ -1,18 +1,26 @@
 #!/bin/env python
 # vim: expandtab ts=4 sw=4 tw=80: 
-import pfiles
+# Heavy dependencies (dicom, pfiles, tabulate) are imported by the functions
+# that use them, so that commands which don't need them start quickly.
 import scu
+import scp
+import compress
+import objectstore
+import scanners
+import processing
+import export
+import metrics
+import state
+import schedule
 from docopt import docopt
 import shutil
 import datetime
-import tabulate
 import tempfile
 import logging
 import os
 import pwd
 import os.path
 import fnmatch
-import dicom
 import glob 
 import sys
 import UserDict
@@ -20,6 +28,11 @@ import re
 import traceback 
 import subprocess
 import shlex
+import itertools
+import threading
+import time
+import multiprocessing
+import multiprocessing.pool
 from collections import defaultdict
 
 VERBOSE = False
@@ -32,6 +45,9 @@ DICOM_PFILEID_KEY = 0x001910a2
 EXAMID_PADDING = 5      # Zero pad chars when formatting exam IDs
 SERIESNUM_PADDING = 5   # Zero pad chars when formatting exam series numbers 
 INSTANCE_PADDING = 5    # Zero pad chars when formatting dicom instance numbers
+CHECK_JOBS = 8          # Series folders to check at once (I/O bound, so threads)
+FREE_SPACE_MARGIN = 1024 ** 3   # Bytes to leave free on the filesystems pulled to
+COMPRESS_JOBS = multiprocessing.cpu_count()    # Dicoms to compress at once
 
 ####
 #  Logging
@@ -103,14 +119,73 @@ def format_dicom_name(examid, series, instance):
     """ 
 
     return "Ex{examid}Se{series}Im{instance}.dcm".format(
-              examid   = examid.zfill(EXAMID_PADDING),
-              series   = seq.zfill(SERIESNUM_PADDING),
-              instance = instance.zfill(INSTANCE_PADDING))
+              examid   = str(examid).zfill(EXAMID_PADDING),
+              series   = str(series).zfill(SERIESNUM_PADDING),
+              instance = str(instance).zfill(INSTANCE_PADDING))
+
+def format_dicom_path(ds, sorteddir, default_instance = 0):
+    """
+    Returns the path a dicom belongs at in a sorted exam folder.
+
+    Series folder naming: Ex#####_Se#####_SeriesDescription, 
+        eg. Ex03806_Se00005_Sag_T1_BRAVO
+    Dicom naming: Ex#####Se#####Im#####.dcm
+
+    <ds> is the pydicom dataset of the file. <default_instance> is used when
+    InstanceNumber isn't in the headers.
+    """
+    examid      = str(ds.get("StudyID"))
+    seriesno    = str(ds.get("SeriesNumber", "UNKNOWN"))
+    seriesdescr = str(ds.get("SeriesDescription","UNKNOWN"))
+    instance    = str(ds.get("InstanceNumber", default_instance))
+
+    seriesdir   = os.path.join(sorteddir, 
+                      format_series_name(examid, seriesno, seriesdescr))
+    return os.path.join(seriesdir, format_dicom_name(examid, seriesno, instance))
 
 ####
 # Helper functions
 ###########################################
 
+def _map_parallel(func, items, jobs): 
+    """ 
+    Calls func on each item, with up to <jobs> calls running at once.
+
+    Returns the list of results, in the order of items.
+    """
+    if jobs <= 1 or len(items) <= 1: 
+        return map(func, items)
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(items)))
+    try: 
+        return pool.map(func, items)
+    finally: 
+        pool.close()
+        pool.join()
+
+def _in_background(func, *args): 
+    """
+    Starts func(*args) on a thread of its own.
+
+    Returns a function that waits for the call to finish, and returns its
+    result (or raises its exception).
+    """
+    outcome = {}
+    def run(): 
+        try: 
+            outcome["result"] = func(*args)
+        except Exception as ex: 
+            outcome["error"] = ex
+    thread = threading.Thread(target = run)
+    thread.daemon = True
+    thread.start()
+
+    def wait(): 
+        thread.join()
+        if "error" in outcome: 
+            raise outcome["error"]
+        return outcome["result"]
+    return wait
+
 def listdir_fullpath(d):
     """
     Returns the full path for subdirectories of d
@@ -126,6 +201,7 @@ def index_dicoms(path, recurse = True, maxdepth = -1, complete = False):
     <maxdepth>  integer, depth to recurse to. -1 = no max depth
     <complete>  boolean, if false only a single dicom file per folder is indexed
     """
+    import dicom
 
     manifest = {}
 
@@ -167,17 +243,28 @@ def index_exams(paths):
         manifest[examdir] = dcm_info.values()[0]
     return manifest 
 
-def find_pfiles(pfile_dir, examdir, examid):
+@metrics.measured("index_pfiles", lambda headers: { "files" : len(headers) })
+def index_pfiles(pfile_dir): 
+    """ Reads the headers of every pfile in pfile_dir (see find_pfiles). """
+    import pfiles
+    return pfiles.get_all_pfiles_headers(pfile_dir)
+
+@metrics.measured("find_pfiles", metrics.file_operations)
+def find_pfiles(pfile_dir, examdir, examid, pfiles_headers = None):
     """
     Finds pfiles that belong as part of an exam. 
 
+    <pfiles_headers> is an index of the pfiles in pfile_dir, as returned by
+    index_pfiles(). It is built if not given, but can be shared when finding
+    pfiles for several exams.
+
     Returns a list of tuples (source, dest), listing files to copy and their
     destination in the examdir. 
     """
-
     files = []  # (source, dest) list of found files
 
-    pfiles_headers = pfiles.get_all_pfiles_headers(pfile_dir)
+    if pfiles_headers is None: 
+        pfiles_headers = index_pfiles(pfile_dir)
     for pfile_path, pfile_headers in pfiles_headers.iteritems():
 
         # skip irrelvant pfiles
@@ -204,6 +291,7 @@ def find_pfiles(pfile_dir, examdir, examid):
 
     return files 
 
+@metrics.measured("sort_exam", metrics.file_operations)
 def sort_exam(unsorteddir, sorteddir): 
     """
     Determines how to move dicom files into well-named series subfolders. 
@@ -211,6 +299,7 @@ def sort_exam(unsorteddir, sorteddir):
     Returns a list of tuples describing each file move operation:
         [ (source, dest), ... ]
     """
+    import dicom
 
     moveoperations = [] 
 
@@ -219,59 +308,47 @@ def sort_exam(unsorteddir, sorteddir):
     for dcm_file in glob.glob(os.path.join(unsorteddir,"*")):
         try: 
             if os.path.isdir(dcm_file): continue 
-            ds = dicom.read_file(dcm_file)
+            ds = dicom.read_file(dcm_file, stop_before_pixels = True)
         except dicom.filereader.InvalidDicomError, e: 
             verbose("File {} is not a dicom. Skipping.".format(dcm_file))  
             continue  # just skip non-dicom files 
 
-        # Series folder naming: Ex#####Se#####_SeriesDescription, eg.  Ex03806_Se00005_Sag_T1_BRAVO
-        # Dicom naming: Ex#####Se#####Im#####.dcm
-
-        examid      = str(ds.get("StudyID"))
-        seriesno    = str(ds.get("SeriesNumber", "UNKNOWN"))
-        seriesdescr = str(ds.get("SeriesDescription","UNKNOWN"))
-        seriesname  = format_series_name(examid, seriesno, seriesdescr)
-        instance    = str(ds.get("InstanceNumber",i))
+        dest_path = format_dicom_path(ds, sorteddir, i)
         del ds 
 
-        seriesdir   = os.path.join(sorteddir, seriesname)
-        dcmname     = "Ex{examid}Se{seriesno}Im{instance}.dcm".format(
-                      examid   = examid.zfill(EXAMID_PADDING),
-                      seriesno = seriesno.zfill(SERIESNUM_PADDING),
-                      instance = instance.zfill(INSTANCE_PADDING))
-
-        dest_path = os.path.join(seriesdir,dcmname)
         moveoperations.append( (dcm_file, dest_path) )
         i = i + 1
 
     return moveoperations
 
-def check_exam_for_pfiles(dcm_info): 
+@metrics.measured("check_exam_for_pfiles", lambda (missing, nonmatching): 
+        { "missing" : len(missing), "nonmatching" : len(nonmatching) })
+def check_exam_for_pfiles(dcm_info, jobs = 1): 
     """
     Check that referenced pfiles exist in proper folders in an exam.
 
     Expects a dictionary mapping a single dicom per series folder to pydicom
-    headers. 
+    headers. The folders are scanned for pfiles <jobs> at a time.
     Returns two lists: 
 
         - directories missing pfiles: [ (dir, pfileid)...]
         - pfiles not matching dir info: [ (pfile path, dcm headers)...]
 
     """
+    import pfiles
     missing_pfiles = []
     nonmatching_pfiles = [] 
 
-    series_checked = []
+    series = {}     # series dir -> headers of a dicom in it
     for dicompath, ds in dcm_info.iteritems():
-        series_dir = os.path.dirname(dicompath)
-
-        if series_dir  in series_checked: continue
-        series_checked.append(series_dir)
-
         if DICOM_PRESSCI_KEY not in ds or \
             ds[DICOM_PRESSCI_KEY].value != "presscsi": continue
+        series.setdefault(os.path.dirname(dicompath), ds)
 
-        pfiles_headers = pfiles.get_all_pfiles_headers(series_dir)
+    series_dirs = sorted(series)
+    scanned = _map_parallel(pfiles.get_all_pfiles_headers, series_dirs, jobs)
+    for series_dir, pfiles_headers in zip(series_dirs, scanned): 
+        ds = series[series_dir]
         pfile_id = ds[DICOM_PFILEID_KEY].value
 
         if len(pfiles_headers) == 0: 
@@ -285,32 +362,211 @@ def check_exam_for_pfiles(dcm_info):
 
     return missing_pfiles, nonmatching_pfiles
 
+####
+# Receiving dicoms from the scanner
+###########################################
+
+class Receiver(object): 
+    """
+    Receives dicoms sent by the scanner, and files each one into the folder of
+    the exam it belongs to (see _file_dicom) as soon as it arrives. The headers
+    of the first dicom filed into each series folder are kept (see headers()),
+    so that the exam needn't be read again to check it.
+
+    <transfer_syntax> is the compressed transfer syntax to accept from the
+    scanner (see scp.TRANSFER_SYNTAXES), and <codec> the lossless compression
+    to store dicoms with (see compress.CODECS), if any. With <objects>, an
+    ObjectStore, dicoms are filed as links into the store. Both happen on a
+    pool of COMPRESS_JOBS threads, so that storescp isn't held up; a dicom
+    counts as received once it is stored.
+    
+    One receiver can serve several pulls, one after another or at once. Files
+    are spooled into a folder in <output_dir> so that they can be renamed into
+    place. Use as a context manager, or call start() and stop().
+    """
+    def __init__(self, connection, output_dir, fork = False, 
+            transfer_syntax = None, codec = None, objects = None): 
+        self.connection   = connection
+        self.output_dir   = output_dir
+        self.fork         = fork
+        self.transfer_syntax = transfer_syntax
+        self.codec        = codec
+        self.objects      = objects
+        self.destinations = {}                  # StudyID -> exam folder
+        self.received     = defaultdict(list)   # exam folder -> [dicom paths]
+        self.series       = defaultdict(dict)   # exam folder -> {series folder : 
+                                                #   (dicom path, headers)}
+        self.instances    = itertools.count()
+        self.condition    = threading.Condition()
+        self.scp          = None
+        self.pool         = None
+
+    def start(self): 
+        if self.codec or self.objects: 
+            self.pool = multiprocessing.pool.ThreadPool(COMPRESS_JOBS)
+        self.spooldir = tempfile.mkdtemp(prefix='.incoming-', dir=self.output_dir)
+        self.scp = scp.StorageSCP(self.connection.return_port, 
+                self.connection.aet, self.spooldir, self._file, fork = self.fork, 
+                transfer_syntax = self.transfer_syntax)
+        try: 
+            self.scp.start()
+        except: 
+            self._stop_pool()
+            shutil.rmtree(self.spooldir)
+            raise
+
+    def stop(self): 
+        try: 
+            self.scp.stop()
+        finally: 
+            self._stop_pool()
+            shutil.rmtree(self.spooldir)
+
+    def _stop_pool(self): 
+        """ Waits for the dicoms being stored. """
+        if not self.pool: return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+    def expect(self, examid, examdir): 
+        """ File dicoms for exam <examid> into <examdir>. """
+        with self.condition: 
+            self.destinations[examid] = examdir
+
+    def files(self, examdir): 
+        """ Returns the dicoms filed into <examdir> so far. """
+        with self.condition: 
+            return list(self.received[examdir])
+
+    def headers(self, examdir): 
+        """ 
+        Returns a dictionary mapping a single dicom per series folder filed into
+        <examdir> to its headers, as index_dicoms() does.
+        """
+        with self.condition: 
+            return dict(self.series[examdir].values())
+
+    def wait_for(self, examdir, count, timeout = 60): 
+        """ 
+        Waits for <count> dicoms to have been filed into <examdir>.
+        
+        Returns False if they weren't within <timeout> seconds.
+        """
+        deadline = time.time() + timeout
+        with self.condition: 
+            while len(self.received[examdir]) < count and time.time() < deadline: 
+                self.condition.wait(deadline - time.time())
+            return len(self.received[examdir]) >= count
+
+    def _file(self, path): 
+        dest, ds = _file_dicom(path, self.destinations, self.instances)
+        if not dest: return
+        if self.pool: 
+            self.pool.apply_async(self._store, (dest, ds))
+        else: 
+            self._received(dest, ds)
+
+    def _store(self, dest, ds): 
+        """ Compresses a dicom filed at <dest> and/or adds it to the store. """
+        try: 
+            if self.codec: 
+                _compress_dicom(dest, self.codec, compress.transfer_syntax(ds))
+            if self.objects: 
+                self.objects.add(dest)
+        except Exception as ex: 
+            warn("Unable to store {}: {}".format(dest, ex))
+        finally: 
+            self._received(dest, ds)
+
+    def _received(self, dest, ds): 
+        seriesdir = os.path.dirname(dest)
+        examdir   = os.path.dirname(seriesdir)
+        with self.condition: 
+            self.received[examdir].append(dest)
+            self.series[examdir].setdefault(seriesdir, (dest, ds))
+            self.condition.notify_all()
+
+    def __enter__(self): 
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb): 
+        self.stop()
+
 ####
 # Command line operations 
 ###########################################
 
 def pull_exams(arguments): 
-    """ Command to pull exams from the scanner. """
-    examid        = arguments['<exam>']
+    """ 
+    Command to pull exams from the scanner. 
+
+    Exams are given as a comma separated list of exam ids, and/or chosen by
+    booking code (-b) or date (-d, which may be a range: <from>-<to>). All of
+    them are looked up with one C-FIND, and pulled <jobs> at a time through one
+    receiver, sharing one index of the pfile dir.
+    """
+    examids       = filter(None, (arguments['<exam>'] or "").split(","))
+    seriesno      = arguments['<series>']
+
+    if not (examids or arguments['-b'] or arguments['-d']): 
+        fatal("Give the exams to pull, a booking code (-b) or a date (-d).")
+    if seriesno and len(examids) != 1: 
+        fatal("A series can only be pulled from a single exam.")
+
+    # processing runs in processes of its own, forked before any threads start
+    # (the scanner is queried on threads)
+    processors = _get_processing(arguments)
+    pulled = False
+    try: 
+        _pull_exams(arguments, examids, processors)
+        pulled = True
+    finally: 
+        _finish_processing(processors, cancel = not pulled)
+
+def _pull_exams(arguments, examids, processors): 
+    """ Internal function to look up and pull the exams for pull_exams. """
     seriesno      = arguments['<series>']
+    bookingcode   = arguments['-b']
+    date          = arguments['-d']
     output_dir    = arguments['-o'] or arguments['--inprocess-dir']
     pfile_dir     = arguments['--pfile-dir'] 
     bare          = arguments['--bare']
+    jobs          = int(arguments['-j'] or 1)
     connection    = _get_scanner_connection(arguments)
 
-    query    = scu.StudyQuery(StudyID = examid)
-    examinfo = connection.find(query)
-
-    if not examinfo: 
-        warn("Exam {} not found on the scanner. Skipping.".format(examid))
+    keys = {}
+    if bookingcode: keys["StudyDescription"] = bookingcode
+    if date:        keys["StudyDate"] = date
+    if len(examids) == 1: keys["StudyID"] = examids[0]
+    found = { exam.get("StudyID") : exam 
+              for exam in connection.find(scu.StudyQuery(**keys)) }
+
+    if examids: 
+        for examid in examids: 
+            if examid not in found: 
+                warn("Exam {} not found on the scanner. Skipping.".format(examid))
+        exams = [ found[examid] for examid in examids if examid in found ]
+    else: 
+        exams = sorted([ exam for examid, exam in found.iteritems() 
+                         if examid and int(examid) <= MIN_SERVICE_EXAM_NUM ], 
+                       key = lambda exam: int(exam["StudyID"]))
+
+    if not exams: 
+        warn("No exams to pull.")
         return 
 
-    debug("Using {} output folder.".format(examid, output_dir))
+    debug("Using {} output folder.".format(output_dir))
 
     if not os.access(output_dir, os.W_OK): 
         fatal("No write access to output folder {}. Exiting.".format(output_dir))
+
+    objects = _get_object_store(arguments)
         
+    query = None
     if seriesno: 
+        examid     = exams[0]["StudyID"]
         query      = scu.SeriesQuery(StudyID = examid, SeriesNumber = seriesno)
         seriesinfo = connection.find(query)
 
@@ -319,15 +575,69 @@ def pull_exams(arguments):
                 examid, seriesno))
             return 
         log("Pulling exam {}, series {} to {}".format(examid, seriesno, output_dir))
-    else:
-        log("Pulling exam {} to {}".format(examid, output_dir))
+    elif len(exams) > 1: 
+        log("Pulling {} exams to {}".format(len(exams), output_dir))
 
-    _pull_exam(connection, examinfo[0], output_dir, pfile_dir, query, bare=bare)
-
-def _pull_exam(connection, examinfo, output_dir, pfile_dir, query, bare=None):
+    # make sure the pull fits before starting it
+    if seriesno: 
+        images = sum(_images(series) for series in seriesinfo)
+    else: 
+        sizes  = _exam_sizes(connection, [exam["StudyID"] for exam in exams])
+        images = sum(sizes[exam["StudyID"]] for exam in exams)
+    past = _past_pulls(arguments)
+    size = schedule.estimate_bytes(images, past and past.bytes_per_image())
+    eta  = schedule.drain_time(images, past and past.throughput(), jobs)
+    log("Estimated pull: {} images, {:.1f} MB, taking {}".format(
+        images, size / 1e6, eta or "unknown"))
+    folder, space, free = _space_to_pull(output_dir, objects)
+    if size > space and not arguments['--force']: 
+        fatal("Not enough space in {} to pull {:.1f} MB ({:.1f} MB free, less "
+              "{:.1f} MB to leave). Use --force to pull anyway.".format(folder, 
+              size / 1e6, free / 1e6, FREE_SPACE_MARGIN / 1e6))
+
+    # index the pfile dir while the first exams are transferred
+    pfiles_headers = None
+    if not bare: 
+        pfiles_headers = _in_background(index_pfiles, pfile_dir)
+
+    def pull(exam): 
+        examid = exam["StudyID"]
+        if not seriesno: 
+            log("Pulling exam {} to {}".format(examid, output_dir))
+        with metrics.exam(examid): 
+            return _pull_exam(connection, exam, output_dir, pfile_dir, 
+                query or scu.StudyQuery(StudyID = examid), bare = bare, 
+                receiver = receiver, pfiles_headers = pfiles_headers, 
+                objects = objects, processors = processors)
+
+    try: 
+        with _get_receiver(arguments, connection, output_dir, 
+                fork = jobs > 1, objects = objects) as receiver: 
+            _map_parallel(pull, exams, jobs)
+    except RuntimeError as ex: 
+        fatal("Unable to receive dicoms: {}".format(ex))
+
+@metrics.measured("pull", lambda counts: counts or {})
+def _pull_exam(connection, examinfo, output_dir, pfile_dir, query, bare=None, 
+        receiver=None, pfiles_headers=None, objects=None, processors=None):
     """Internal method to pull exam data from the scanner. 
 
     <examinfo> is dictionary of exam details.
+    <receiver> is a running Receiver to share with other pulls. If not given,
+    one is started for this pull.
+    <pfiles_headers> is a shared index of the pfile dir (see find_pfiles), or a
+    function that returns one (see _in_background). If not given, the pfile dir
+    is indexed while the dicoms are transferred.
+    <objects> is the ObjectStore to place files into, if any.
+    <processors> is the processing.ProcessingPool to queue the exam on once it
+    has been pulled, if any.
+
+    Dicoms are filed into series folders as they arrive, so the pull takes
+    about as long as the slowest of the transfer and the pfile dir scan, rather
+    than the sum of transferring, sorting and scanning.
+
+    Returns a dictionary with the number of "files" and "bytes" received, or
+    None if the transfer failed.
     """
 
     studydescr = examinfo.get("StudyDescription","UNKNOWN")
@@ -340,50 +650,123 @@ def _pull_exam(connection, examinfo, output_dir, pfile_dir, query, bare=None):
     examdir     = os.path.join(output_dir,examdirname)
    
     ###
-    ## Copy dicoms from the scanner, and organize them into series folders
+    ## Receive dicoms from the scanner straight into their series folders
     ###
-    tempdir = tempfile.mkdtemp()
-    debug("Fetching DICOMS into {0}".format(tempdir))
+    if not os.path.exists(examdir): os.makedirs(examdir) 
+
+    if not bare and pfiles_headers is None: 
+        pfiles_headers = _in_background(index_pfiles, pfile_dir)
+
+    debug("Receiving DICOMS into {0}".format(examdir))
+    own_receiver = receiver is None
+    if own_receiver: 
+        receiver = Receiver(connection, output_dir, objects = objects)
+    receiver.expect(examid, examdir)
 
     try:
-        connection.move(query, tempdir)
+        with metrics.phase("receive") as counts:
+            if own_receiver: receiver.start()
+            try: 
+                expected = connection.move(query, dest_aet = connection.aet)
+            finally: 
+                if own_receiver: receiver.stop()
+
+            if not receiver.wait_for(examdir, expected, 0 if own_receiver else 60): 
+                warn("Exam {}: scanner sent {} dicoms but {} were received.".format(
+                    examid, expected, len(receiver.files(examdir))))
+            received = receiver.files(examdir)
+            counts["files"] = len(received)
+            counts["bytes"] = sum(os.path.getsize(f) for f in received)
     except subprocess.CalledProcessError as ex: 
         log("Dicom transfer failed: {}".format(ex.output))
         return 
-
-    # move dicom files into folders
-    debug("Sorting dicoms from {} into {}".format(tempdir, examdir))
-    if not os.path.exists(examdir): os.makedirs(examdir) 
-    _sort_exam(tempdir, examdir)
-    shutil.rmtree(tempdir)
+    except RuntimeError as ex: 
+        log("Unable to receive dicoms: {}".format(ex))
+        return 
 
     # fetch all non-dicom data for the exam
     if not bare:
-        _fetch_nondicom_exam_data(examdir, examid, pfile_dir)
-
-def _sort_exam(unsorteddir, sorteddir): 
-    """ Internal function rename dicoms into series folders. """
-    # move dicom files into folders
-    moveops = sort_exam(unsorteddir, sorteddir)
-    for source, dest in moveops: 
-        debug("Moving {} to {}".format(source, dest))
-        if not os.path.exists(os.path.dirname(dest)): 
-            os.makedirs(os.path.dirname(dest))
-        shutil.copyfile(source,dest)
-
-def _fetch_nondicom_exam_data(examdir, examid, pfile_dir): 
-    """ Find perhipheral data """
+        _fetch_nondicom_exam_data(examdir, examid, pfile_dir, pfiles_headers, 
+                receiver.headers(examdir), objects)
+
+    if processors: 
+        jobs = processors.submit(examid, receiver.headers(examdir))
+        debug("Queued {} processing jobs for exam {}".format(jobs, examid))
+
+    return counts
+
+def _compress_dicom(path, codec, syntax = None): 
+    """ 
+    Internal function to recompress a dicom losslessly, in place. 
+    
+    The dicom is left as it is, with a warning, if that isn't possible.
+    """
+    try: 
+        if compress.compress(path, codec, syntax): 
+            debug("Compressed {} with {}".format(path, codec))
+    except OSError as ex: 
+        warn("Unable to compress {} with {}: {}".format(path, 
+            compress.CODECS[codec][0], ex))
+    except subprocess.CalledProcessError as ex: 
+        warn("Unable to compress {}: {}".format(path, ex.output))
+
+def _file_dicom(path, destinations, instances): 
+    """
+    Internal function to rename a received dicom into its series folder. 
+    
+    <destinations> maps StudyID to the exam folder for that exam.
+    <instances> is a counter used when InstanceNumber isn't in the headers.
+
+    Returns the destination path and the dicom headers, or (None, None) if the
+    file was left in place.
+    """
+    import dicom
+    try: 
+        ds = dicom.read_file(path, stop_before_pixels = True)
+    except dicom.filereader.InvalidDicomError, e: 
+        verbose("Received file {} is not a dicom. Skipping.".format(path))
+        return None, None
+
+    examid = str(ds.get("StudyID"))
+    if examid not in destinations: 
+        warn("Received dicom {} for unexpected exam {}. Skipping.".format(
+            path, examid))
+        return None, None
+
+    dest = format_dicom_path(ds, destinations[examid], instances.next())
+    debug("Filing {} as {}".format(path, dest))
+    if not os.path.exists(os.path.dirname(dest)): 
+        os.makedirs(os.path.dirname(dest))
+    os.rename(path, dest)
+    return dest, ds
+
+def _fetch_nondicom_exam_data(examdir, examid, pfile_dir, pfiles_headers = None, 
+        dicom_info = None, objects = None): 
+    """ 
+    Find perhipheral data 
+    
+    <pfiles_headers> and <objects> are as for _pull_exam. <dicom_info> maps a
+    dicom per series folder to its headers, as from index_dicoms(examdir) (which
+    is used if not given).
+    """
     ###
     ## Copy pFiles and related pfile assets
     ###
     debug("Searching for pfiles matching this exam...")
-    copyops = find_pfiles(pfile_dir, examdir, examid)
-    for source, dest in copyops: 
-        debug("Copying {} to {}".format(source, dest))
-        directory = os.path.dirname(dest)
-        if not os.path.exists(directory): 
-            os.makedirs(directory)
-        shutil.copy(source, dest)
+    if callable(pfiles_headers): 
+        pfiles_headers = pfiles_headers()
+    copyops = find_pfiles(pfile_dir, examdir, examid, pfiles_headers)
+    with metrics.phase("copy_pfiles") as counts: 
+        for source, dest in copyops: 
+            debug("Copying {} to {}".format(source, dest))
+            directory = os.path.dirname(dest)
+            if not os.path.exists(directory): 
+                os.makedirs(directory)
+            if objects: 
+                objects.place(source, dest)
+            else: 
+                shutil.copy(source, dest)
+        counts.update(metrics.file_operations(copyops))
 
     ###
     ## Check dicom headers for related pfiles
@@ -392,7 +775,9 @@ def _fetch_nondicom_exam_data(examdir, examid, pfile_dir):
     ## header set to "presssci".  
     ###
     debug("Checking whether all pfiles have been found...")
-    dicom_info = index_dicoms(examdir)
+    if dicom_info is None: 
+        with metrics.phase("index_dicoms"):
+            dicom_info = index_dicoms(examdir)
     missing_pfiles, nonmatching_pfiles = check_exam_for_pfiles(dicom_info) 
     for series_dir, pfile_id in missing_pfiles:
         warn("Expected pfile (id: {}) in {} but none were found.".format(
@@ -423,12 +808,21 @@ def package_exams(arguments):
     examstem = os.path.basename(examdir)
     destdir  = os.path.join(processed_dir, examstem)
 
-    warnings = _check_inprocess(examid, examdir, connection)
+    warnings = _check_inprocess(examid, examdir, connection, 
+            deep = arguments['--deep'])
     
     if os.path.exists(destdir):
         warn("{0} folder already exists. Skipping.".format(destdir))
         return
 
+    # moving to another filesystem copies the exam
+    if os.stat(examdir).st_dev != os.stat(processed_dir).st_dev: 
+        size = _folder_size(examdir)
+        (folder, free), = _free_space([processed_dir])
+        if size > free - FREE_SPACE_MARGIN: 
+            warnings.append("Not enough space in {} for exam {} ({:.1f} MB, "
+                "{:.1f} MB free).".format(folder, examid, size / 1e6, free / 1e6))
+
     for warning in warnings: warn(warning)
 
     if warnings and not arguments['--force']: 
@@ -439,6 +833,12 @@ def package_exams(arguments):
     log("Moving exam {0} to {1}".format(examid, destdir))
     shutil.move(examdir, processed_dir)
 
+    objects = _get_object_store(arguments)
+    if objects: 
+        verbose("Placing {0} into the object store".format(destdir))
+        with metrics.phase("store_objects") as counts: 
+            counts["files"] = _store_folder(objects, destdir)
+
     verbose("Setting read-only permissions on {0}".format(destdir))
     try:
         output = subprocess.check_output(
@@ -449,12 +849,37 @@ def package_exams(arguments):
 
             
 def list_exams(arguments): 
-    processed_dir = arguments['--processed-dir']
-    inprocess_dir = arguments['--inprocess-dir']
+    """
+    List the exams on the scanner. 
 
-    connection = _get_scanner_connection(arguments)
+    With --scanners, every scanner in the config file is asked at once, and the
+    exams are listed together, with the scanner each is on.
+    """
+    import tabulate
+
+    headers = [ "StudyID", "StudyDate", "PatientID", "StudyDescription", 
+                "PatientName", "Staged" ] 
+    if arguments['--scanners']: 
+        configured = _read_scanners(arguments)
+        finds   = [ _get_scanner_connection(settings).find_async(scu.StudyQuery()) 
+                    for name, settings in configured ]
+        table   = [] 
+        for (name, settings), find in zip(configured, finds): 
+            table.extend(dict(row, Scanner = name) 
+                    for row in _list_scanner_exams(settings, find.result()))
+        headers = ["Scanner"] + headers
+    else: 
+        connection = _get_scanner_connection(arguments)
+        table   = _list_scanner_exams(arguments, connection.find(scu.StudyQuery()))
 
-    records    = connection.find(scu.StudyQuery())
+    # sort, de-dictionary and print
+    table  = sorted(table, key=lambda row: (row.get('Scanner'), int(row['StudyID'])))
+    table  = [ [r[h] for h in headers]  for r in table ]
+    log("\n{}\n".format(tabulate.tabulate(table, headers=headers)))
+
+def _list_scanner_exams(arguments, records): 
+    """ Internal function to filter the exams found on a scanner for list_exams. """
+    inprocess_dir = arguments['--inprocess-dir']
 
     headers = [ "StudyID", "StudyDate", "PatientID", "StudyDescription", "PatientName"] 
     table   = [ { key : r.get(key,"") for key in headers } for r in records ]
@@ -474,20 +899,16 @@ def list_exams(arguments):
         
         
     # check if inprocess
-    headers = headers + ["Staged"]
     for row in table: 
         studyid = row['StudyID']
         row["Staged"] = glob.glob(inprocess_dir+"/*_Ex"+studyid+"_*") and "yes" or "no"
-    
-    # sort, de-dictionary and print
-    table  = sorted(table, key=lambda row: int(row['StudyID']))
-    table  = [ [r[h] for h in headers]  for r in table ]
-    log("\n{}\n".format(tabulate.tabulate(table, headers=headers)))
+    return table
 
 def list_series(arguments):
     """
     List the series for an exam. 
     """
+    import tabulate
     examid     = arguments['<exam>']
     connection = _get_scanner_connection(arguments)
     records    = connection.find(scu.SeriesQuery(StudyID = examid))
@@ -502,6 +923,7 @@ def show_inprocess(arguments):
     """
     Show the exams in the inprocess area.
     """
+    import tabulate
 
     processed_dir  = arguments['--processed-dir']
     inprocess_dir= arguments['--inprocess-dir']
@@ -521,35 +943,56 @@ def show_inprocess(arguments):
     table = sorted(table, key=lambda row: int(row[1]))   #  sort by study id 
     log("\n{}\n".format(tabulate.tabulate(table, headers=headers)))
 
-def check_series_dicoms(examdir, examid, seriesinfo):
+def scan_exam(examdir, jobs = CHECK_JOBS): 
+    """
+    Lists the dicoms in each series folder of an exam.
+
+    The exam folder is listed once, and its series folders <jobs> at a time.
+    Returns a dictionary mapping each series folder name to the sorted names of
+    the dicoms (*.dcm) in it.
+    """
+    folders = [ name for name in os.listdir(examdir) 
+                if name.startswith("Ex") and "_Se" in name ]
+    def dicoms(name): 
+        try: 
+            return sorted(f for f in os.listdir(os.path.join(examdir, name)) 
+                          if f.endswith(".dcm"))
+        except OSError:     # not a folder
+            return None
+    listings = _map_parallel(dicoms, folders, jobs)
+    return { name : listing for name, listing in zip(folders, listings) 
+             if listing is not None }
+
+def check_series_dicoms(examdir, examid, seriesinfo, folders = None):
     """
     Checks that all series are present with correct dicom files. 
 
     <seriesinfo> is a list of dictionaries for each expected series. The
     dictionary for a series contains Dicom attributes: StudyID, SeriesNumber,
     SeriesDescription, ImagesInAcquistion.
+    <folders> is the listing of the exam from scan_exam(), if already made.
 
     Returns an empty list if all checks pass, and a list of user warnings
     otherwise. 
     """
+    if folders is None: 
+        folders = scan_exam(examdir)
 
     warnings = [] 
 
     for info in seriesinfo: 
-        series      = info.get("SeriesNumber","")
-        seriesdescr = info.get("SeriesDescription","UNKNOWN")
-        numimages   = int(info.get("ImagesInAcquisition",0))
-        seriesname  = format_series_name(examid, series, seriesdescr)
+        seriesname  = _series_folder_name(examid, info)
         seriesdir   = os.path.join(examdir, seriesname)
+        numimages   = int(info.get("ImagesInAcquisition",0))
 
         # Confirm series folder exists, if it doesn't: warn
-        if not os.path.exists(seriesdir):
+        if seriesname not in folders:
             warnings.append("Exam {}: expected series folder {} does not exist.".format(
                 examid, seriesdir))
             continue
 
         # Confirm series folder has dicom data in it that matches the series
-        dicoms = glob.glob(seriesdir+"/*.dcm")
+        dicoms = folders[seriesname]
 
         if len(dicoms) != numimages:
             warnings.append("Series {} has {} dicoms, expected {}.".format(
@@ -558,6 +1001,87 @@ def check_series_dicoms(examdir, examid, seriesinfo):
 
     return warnings
 
+@metrics.measured("check_instances", lambda report: { 
+    "missing" : sum(len(series["missing"]) for series in report), 
+    "extra"   : sum(len(series["extra"]) for series in report) })
+def check_series_instances(connection, examdir, examid, seriesinfo, 
+        folders = None, jobs = CHECK_JOBS):
+    """
+    Compares the SOPInstanceUIDs of the dicoms in each series folder with those
+    the scanner has for the series (from an image-level C-FIND).
+
+    The C-FINDs and the header reads run <jobs> at a time. Returns a report, a
+    list with a dictionary for each series that is present: 
+
+        series      the SeriesNumber
+        folder      the series folder
+        missing     SOPInstanceUIDs on the scanner but not in the folder
+        extra       paths of dicoms in the folder that aren't on the scanner,
+                    or aren't dicoms
+        duplicates  lists of the paths of dicoms that have the same
+                    SOPInstanceUID
+    """
+    import dicom
+    if folders is None: 
+        folders = scan_exam(examdir, jobs)
+
+    present = [ (info, _series_folder_name(examid, info)) for info in seriesinfo ]
+    present = [ (info, name) for info, name in present if name in folders ]
+
+    def expected(info): 
+        return set(str(response.get("SOPInstanceUID")) for response in 
+            connection.find(scu.ImageQuery(StudyID = examid, 
+                SeriesNumber = info.get("SeriesNumber"), SOPInstanceUID = "")))
+    def received(path): 
+        try: 
+            return path, str(dicom.read_file(path, stop_before_pixels = True).get(
+                "SOPInstanceUID"))
+        except dicom.filereader.InvalidDicomError: 
+            return path, None
+
+    paths = [ os.path.join(examdir, name, dicomname) 
+              for info, name in present for dicomname in folders[name] ]
+    uids  = dict(_map_parallel(received, paths, jobs))
+    finds = _map_parallel(expected, [ info for info, name in present ], jobs)
+
+    report = []
+    for (info, name), scanner_uids in zip(present, finds): 
+        seriesdir = os.path.join(examdir, name)
+        local = defaultdict(list)   # SOPInstanceUID -> [paths]
+        for dicomname in folders[name]: 
+            path = os.path.join(seriesdir, dicomname)
+            local[uids[path]].append(path)
+        report.append({ "series"     : info.get("SeriesNumber"), 
+                        "folder"     : seriesdir, 
+                        "missing"    : sorted(scanner_uids - set(local)), 
+                        "extra"      : sorted(path for uid, paths in local.items() 
+                                              if uid not in scanner_uids 
+                                              for path in paths), 
+                        "duplicates" : sorted(paths for uid, paths in local.items() 
+                                              if uid and len(paths) > 1) })
+    return report
+
+def _series_folder_name(examid, info): 
+    return format_series_name(examid, info.get("SeriesNumber",""), 
+            info.get("SeriesDescription","UNKNOWN"))
+
+def _series_headers(examdir, folders, jobs = CHECK_JOBS): 
+    """
+    Reads the headers of the first dicom in each series folder, <jobs> at a
+    time, as index_dicoms(examdir) does for a single series.
+
+    Returns a dictionary mapping each dicom read to its headers.
+    """
+    import dicom
+    paths = [ os.path.join(examdir, name, dicoms[0]) 
+              for name, dicoms in sorted(folders.items()) if dicoms ]
+    def read(path): 
+        try: 
+            return path, dicom.read_file(path, stop_before_pixels = True)
+        except dicom.filereader.InvalidDicomError: 
+            return path, None
+    return { path : ds for path, ds in _map_parallel(read, paths, jobs) if ds }
+
 def check_inprocess(arguments):
     """
     Check that a inprocess exam is complete. 
@@ -567,6 +1091,8 @@ def check_inprocess(arguments):
         - Each series has the expected number of dicom files
         - All pfile data is present
         - All physio data is present
+        - With --deep, each series has the dicoms the scanner has (by
+          SOPInstanceUID), and no others
     """
     processed_dir = arguments['--processed-dir']
     inprocess_dir = arguments['--inprocess-dir']
@@ -586,23 +1112,36 @@ def check_inprocess(arguments):
     examinfo = inprocess_exams[inprocess_by_id[examid]]
     examname = format_exam_name(examinfo)
     examdir  = os.path.join(inprocess_dir, examname)
-    warnings = _check_inprocess(examid, examdir, connection)
+    warnings = _check_inprocess(examid, examdir, connection, 
+            deep = arguments['--deep'])
 
     for warning in warnings: warn(warning)
     if not warnings: log("All dicom files present for exam {}".format(examid))
 
 def sync(arguments):
-    """ Pulls all unpulled exams into the processing folder. """
+    """ 
+    Pulls all unpulled exams into the processing folder. 
+    
+    With --scanners, every scanner in the config file is synced at once (see
+    _sync_scanners).
+    """
+    if arguments['--scanners']: 
+        _sync_scanners(arguments)
+        return
+
     req_examid    = arguments['-e']
     log_dir       = arguments['--log-dir'] 
-    output_dir    = arguments['--inprocess-dir']
-    pfile_dir     = arguments['--pfile-dir'] 
+    try: 
+        scheduler = schedule.Scheduler(schedule.parse_limits(arguments['--limits']))
+    except schedule.ScheduleError as ex: 
+        fatal(str(ex))
 
-    # attach sync.log handler
+    # attach sync.log handler, and record metrics alongside it
     logfile = os.path.join(log_dir, 'sync.log')
     fh = logging.FileHandler(logfile)
     fh.setLevel(logging.INFO)
     logging.getLogger().addHandler(fh)
+    metrics.configure(os.path.join(log_dir, 'metrics.jsonl'))
 
     # begin
     log("Starting sync: {}".format(datetime.datetime.now()))
@@ -610,14 +1149,39 @@ def sync(arguments):
     if req_examid: 
         log("Exam ID {} requested for sync".format(req_examid))
 
-    pulled  = []
-    logfilepath = os.path.join(log_dir, 'exams.txt')
-    if os.path.exists(logfilepath): 
-        pulled = open(logfilepath,'r').read().split("\n")
-
-    logfile = open(logfilepath,'a')
-    connection = _get_scanner_connection(arguments)
+    # the state of every exam, which may be shared by syncs on other hosts
+    state_dir = arguments['--state-dir'] or log_dir
+    if not os.path.exists(state_dir): 
+        os.makedirs(state_dir)
+    store = state.StateStore(os.path.join(state_dir, 'exams.db'))
+    imported = store.import_exams_txt(arguments.get('--exams-txt') or 
+            os.path.join(log_dir, 'exams.txt'))
+    if imported: 
+        log("Imported {} pulled exams from exams.txt".format(imported))
+
+    # processing runs in processes of its own, forked before any threads start
+    # (the scanner is queried on threads), and its progress is kept with the
+    # state of each exam
+    processors = _get_processing(arguments, 
+        lambda examid, name, seriesdir, status, message: store.record_processing(
+            examid, name, os.path.basename(seriesdir), status, message))
+    synced = False
+    try: 
+        _sync_exams(arguments, store, scheduler, processors)
+        synced = True
+    finally: 
+        _finish_processing(processors, cancel = not synced)
+
+def _sync_exams(arguments, store, scheduler, processors): 
+    """ Internal function to queue and pull the exams left to pull for sync. """
+    req_examid    = arguments['-e']
+    output_dir    = arguments['--inprocess-dir']
+    pfile_dir     = arguments['--pfile-dir'] 
+    order         = arguments['--order']
+    pulled        = store.with_status(state.DONE)
+    connection    = _get_scanner_connection(arguments)
 
+    exams = [] 
     for exam in  connection.find(scu.StudyQuery()):
         examid = exam.get("StudyID","")
 
@@ -628,25 +1192,278 @@ def sync(arguments):
         if req_examid and examid != req_examid:
             continue
 
-        debug("Using {} output folder.".format(output_dir))
+        exams.append(exam)
+    store.queue([exam["StudyID"] for exam in exams])
+    if not exams: 
+        return
+
+    sizes = _exam_sizes(connection, [exam["StudyID"] for exam in exams])
+    try: 
+        exams = schedule.order_exams(exams, order, sizes)
+    except schedule.ScheduleError as ex: 
+        fatal(str(ex))
+
+    # pull only as many exams as there is space for
+    objects = _get_object_store(arguments)
+    exams   = _fit_space(store, exams, sizes, output_dir, objects)
+    if not exams: 
+        return
+    _report_queue(store, exams, sizes, scheduler.jobs())
+
+    # one index of the pfile dir (built while the first exams are transferred)
+    # and one receiver serve every exam pulled
+    pfiles_headers = _in_background(index_pfiles, pfile_dir)
+
+    debug("Using {} output folder.".format(output_dir))
+    try: 
+        with _get_receiver(arguments, connection, output_dir, 
+                fork = scheduler.max_jobs() > 1, objects = objects) as receiver: 
+            remaining = scheduler.run(exams, 
+                lambda exam: _sync_exam(store, connection, exam, output_dir, 
+                    pfile_dir, receiver, pfiles_headers, objects, processors), 
+                lambda exam, queued: _report_queue(store, queued, sizes, 
+                    scheduler.jobs()))
+    except RuntimeError as ex: 
+        fatal("Unable to receive dicoms: {}".format(ex))
+
+    if remaining: 
+        log("Pulling is paused by --limits. {} exams are left for the next "
+            "sync.".format(len(remaining)))
+
+def _sync_scanners(arguments): 
+    """
+    Internal function to sync every scanner in the --scanners file at once.
+
+    Each scanner is synced in a process of its own, with its own settings, log
+    folder (and so its own sync state), pfile scan and limits.
+    """
+    processes = []
+    for name, settings in _read_scanners(arguments): 
+        if not os.path.exists(settings['--log-dir']): 
+            os.makedirs(settings['--log-dir'])
+        process = multiprocessing.Process(target = _sync_scanner, 
+                args = (name, settings), name = name)
+        process.start()
+        processes.append(process)
+
+    failed = []
+    for process in processes: 
+        process.join()
+        if process.exitcode: 
+            failed.append(process.name)
+    if failed: 
+        fatal("Sync failed for scanners: {}".format(", ".join(failed)))
+
+def _sync_scanner(name, settings): 
+    """ Internal function to sync one scanner, in its own process. """
+    for handler in logging.getLogger().handlers: 
+        handler.setFormatter(logging.Formatter(name + ": %(message)s"))
+    sync(settings)
+
+def _read_scanners(arguments): 
+    try: 
+        return scanners.read_scanners(arguments['--scanners'], arguments)
+    except scanners.ConfigError as ex: 
+        fatal(str(ex))
+
+def _exam_sizes(connection, examids): 
+    """
+    Returns a dictionary mapping exam id to the number of images in the exam.
+
+    Asks for the series of each exam, a few exams at once.
+    """
+    sizes = defaultdict(int)
+    for batch in range(0, len(examids), 4): 
+        finds = [ (examid, connection.find_async(scu.SeriesQuery(
+                      StudyID = examid, ImagesInAcquisition = ""))) 
+                  for examid in examids[batch:batch + 4] ]
+        for examid, find in finds: 
+            for series in find.result(): 
+                sizes[examid] += _images(series)
+    return sizes
+
+def _images(series): 
+    """ Returns the ImagesInAcquisition of a series C-FIND response, or 0. """
+    try: 
+        return int(series.get("ImagesInAcquisition") or 0)
+    except ValueError: 
+        return 0
+
+def _report_queue(store, exams, sizes, jobs): 
+    """ Logs how many exams are left for sync, and how long they may take. """
+    images = sum(sizes.get(exam["StudyID"], 0) for exam in exams)
+    size   = schedule.estimate_bytes(images, store.bytes_per_image())
+    eta    = schedule.drain_time(images, store.throughput(), jobs)
+    log("Queue: {} exams, {} images, {:.1f} MB. Estimated time to drain: {}".format(
+        len(exams), images, size / 1e6, eta or "unknown"))
+
+def _fit_space(store, exams, sizes, output_dir, objects = None): 
+    """
+    Returns the exams (in order) that fit in the space free to pull them into,
+    by the size estimated from their images and the bytes per image of past
+    pulls. The rest are left for a later sync.
+    """
+    bytes_per_image = store.bytes_per_image()
+    estimates = { examid : schedule.estimate_bytes(images, bytes_per_image) 
+                  for examid, images in sizes.items() }
+    folder, space = _space_to_pull(output_dir, objects)[:2]
+    exams, left = schedule.fit_space(exams, estimates, space)
+    if left: 
+        warn("Not enough space in {} for {} exams ({:.1f} MB). They are left "
+             "for the next sync.".format(folder, len(left), 
+             sum(estimates.get(exam["StudyID"], 0) for exam in left) / 1e6))
+    return exams
+
+def _space_to_pull(output_dir, objects = None): 
+    """
+    Returns the folder with the least space free of those a pull writes to
+    (the output folder, where dicoms are also spooled as they arrive, and the
+    object store), the bytes that may be pulled into it, leaving
+    FREE_SPACE_MARGIN free, and the bytes free in it.
+    """
+    folders = [output_dir] + (objects and [objects.root] or [])
+    folder, free = min(_free_space(folders), key = lambda (folder, free): free)
+    return folder, max(0, free - FREE_SPACE_MARGIN), free
+
+def _free_space(folders): 
+    """
+    Returns the bytes free (to unprivileged users) on the filesystem of each
+    folder, as a list of (folder, bytes) with one folder per filesystem.
+    """
+    devices, space = set(), []
+    for folder in folders: 
+        device = os.stat(folder).st_dev
+        if device in devices: continue
+        devices.add(device)
+        st = os.statvfs(folder)
+        space.append((folder, st.f_bavail * st.f_frsize))
+    return space
+
+def _folder_size(folder): 
+    """ Returns the bytes of the files in a folder, and its subfolders. """
+    return sum(os.path.getsize(os.path.join(path, name)) 
+               for path, dirs, files in os.walk(folder) for name in files)
+
+def _past_pulls(arguments): 
+    """ 
+    Returns the StateStore that sync keeps of past pulls, opened read-only, if
+    there is one, to estimate pulls by.
+    """
+    path = os.path.join(arguments['--state-dir'] or arguments['--log-dir'], 
+            'exams.db')
+    return os.path.exists(path) and state.StateStore(path, readonly = True) \
+            or None
+
+def _sync_exam(store, connection, exam, output_dir, pfile_dir, receiver, 
+        pfiles_headers, objects = None, processors = None): 
+    """ Internal function to claim and pull an exam for sync. """
+    examid = exam["StudyID"]
+    previous = store.status(examid)
+    if not store.claim(examid): 
+        log("Exam {} was pulled by another sync, or is being pulled. "
+            "Skipping.".format(examid))
+        return
 
-        query = scu.StudyQuery(StudyID = examid)
+    query = scu.StudyQuery(StudyID = examid)
+    if previous == state.PULLING: 
+        log("Resuming interrupted pull of exam {} to {}".format(examid, output_dir))
+    else: 
         log("Pulling exam {} to {}".format(examid, output_dir))
-        _pull_exam(connection, exam, output_dir, pfile_dir, query)
-        logfile.write(exam['StudyID']+'\n')
+    start = datetime.datetime.now()
+    try: 
+        with metrics.exam(examid), store.heartbeat(examid):
+            counts = _pull_exam(connection, exam, output_dir, pfile_dir, query, 
+                    receiver = receiver, pfiles_headers = pfiles_headers, 
+                    objects = objects, processors = processors)
+    except Exception as ex: 
+        store.fail(examid, str(ex))
+        raise
+
+    if counts is None: 
+        ended = store.fail(examid, "Dicom transfer failed")
+    else: 
+        ended = store.finish(examid, images = counts["files"], 
+                bytes = counts["bytes"])
+    if not ended: 
+        warn("Exam {} was claimed by another sync while it was being pulled, "
+             "after our claim expired. Leaving its status to that sync.".format(
+             examid))
+    elif counts is not None: 
+        log("Pulled exam {} in {}".format(examid, datetime.datetime.now() - start))
     
+
+def _get_receiver(arguments, connection, output_dir, fork = False, 
+        objects = None): 
+    """ Returns a Receiver using the --transfer and --compress options. """
+    transfer_syntax = arguments['--transfer'] or 'uncompressed'
+    codec           = arguments['--compress']
+    if transfer_syntax not in scp.TRANSFER_SYNTAXES: 
+        fatal("Unknown transfer syntax {}. Expected one of: {}".format(
+            transfer_syntax, ", ".join(sorted(scp.TRANSFER_SYNTAXES))))
+    if codec and codec not in compress.CODECS: 
+        fatal("Unknown compression {}. Expected one of: {}".format(
+            codec, ", ".join(sorted(compress.CODECS))))
+    return Receiver(connection, output_dir, fork = fork, 
+            transfer_syntax = transfer_syntax, codec = codec, objects = objects)
+
+def _get_processing(arguments, on_status = None): 
+    """ 
+    Returns a processing.ProcessingPool running the --process processors, or
+    None if there are none.
+    """
+    names = filter(None, (arguments['--process'] or "").split(","))
+    if not names: 
+        return None
+    try: 
+        return processing.ProcessingPool(names, int(arguments['--process-jobs']), 
+                on_status)
+    except ValueError as ex: 
+        fatal(str(ex))
+
+def _finish_processing(processors, cancel = False): 
+    """ 
+    Waits for the processing of pulled exams to finish, or stops it if the pull
+    was cut short (<cancel>).
+    """
+    if not processors: return
+    if cancel: 
+        processors.terminate()
+        return
+    log("Waiting for processing to finish...")
+    with metrics.phase("processing"): 
+        processors.close()
+
+def _get_object_store(arguments): 
+    """ Returns the ObjectStore given by --object-store, or None. """
+    root = arguments['--object-store']
+    return root and objectstore.ObjectStore(root) or None
+
+def _store_folder(objects, folder): 
+    """ Places every file in folder into the object store. Returns the count. """
+    count = 0
+    for path, dirs, files in os.walk(folder): 
+        for f in files: 
+            if objects.add(os.path.join(path, f)): 
+                count += 1
+    return count
+
 def _get_scanner_connection(arguments): 
     host       = arguments['--host']
     port       = arguments['--port']
     aet        = arguments['--aet']
     aec        = arguments['--aec']
-    rport      = port    # return port is the same (for now)
+    rport      = arguments['--return-port'] or port
     return scu.SCU(host, port, rport, aet, aec) 
 
-def _check_inprocess(examid, examdir, connection):
+def _check_inprocess(examid, examdir, connection, deep = False, 
+        jobs = CHECK_JOBS):
     """
     Internal method for doing all checks on a inprocess exam. See check_inprocess
 
+    The series folders are listed once, and checked <jobs> at a time. If <deep>
+    is set, the dicoms of each series are also matched against the scanner's
+    by SOPInstanceUID (see check_series_instances).
+
     Returns [] if successful, and a list of user warnings otherwise
     """
     warnings = []
@@ -659,12 +1476,30 @@ def _check_inprocess(examid, examdir, connection):
             "Exam {} not on scanner. Unable to check series count.".format(
                 examid))
 
-    warnings.extend(check_series_dicoms(examdir, examid, seriesinfo))
+    with metrics.phase("scan_exam") as counts: 
+        folders = scan_exam(examdir, jobs)
+        counts["files"] = sum(len(dicoms) for dicoms in folders.values())
+    warnings.extend(check_series_dicoms(examdir, examid, seriesinfo, folders))
+
+    if deep: 
+        for series in check_series_instances(connection, examdir, examid, 
+                seriesinfo, folders, jobs): 
+            if series["missing"]: 
+                warnings.append("Series {} is missing {} instances: {}".format(
+                    series["folder"], len(series["missing"]), 
+                    ", ".join(series["missing"])))
+            if series["extra"]: 
+                warnings.append("Series {} has {} dicoms not on the scanner: {}".format(
+                    series["folder"], len(series["extra"]), 
+                    ", ".join(series["extra"])))
+            for paths in series["duplicates"]: 
+                warnings.append("Series {} has {} copies of an instance: {}".format(
+                    series["folder"], len(paths), ", ".join(paths)))
 
     ####
     # Check that all pfile data is present
-    dicom_info = index_dicoms(examdir)
-    missing_pfiles, nonmatching_pfiles = check_exam_for_pfiles(dicom_info) 
+    dicom_info = _series_headers(examdir, folders, jobs)
+    missing_pfiles, nonmatching_pfiles = check_exam_for_pfiles(dicom_info, jobs) 
     for series_dir, pfile_id in missing_pfiles:
         warnings.append(
             "Expected pfile (id: {}) in {} but none were found.".format(
@@ -676,8 +1511,55 @@ def _check_inprocess(examid, examdir, connection):
     
     return warnings
 
+def collect_garbage(arguments): 
+    """ 
+    Removes the objects in the object store that no exam uses any more, and
+    reports the space the store saves.
+    """
+    import tabulate
+    objects = _get_object_store(arguments)
+    if not objects: 
+        fatal("No object store given. Use --object-store=<dir>.")
+
+    count, size = objects.gc()
+    log("Removed {} unused objects ({:.1f} MB)".format(count, size / 1e6))
+
+    usage = objects.usage()
+    table = [ ["Objects",                 usage["objects"]], 
+              ["Links to objects",        usage["links"]], 
+              ["Stored (MB)",             "{:.1f}".format(usage["stored"] / 1e6)], 
+              ["Linked (MB)",             "{:.1f}".format(usage["linked"] / 1e6)], 
+              ["Saved by linking (MB)",   "{:.1f}".format(usage["saved"] / 1e6)] ]
+    log("\n{}\n".format(tabulate.tabulate(table, headers=["Object store", ""])))
+
+def export_headers(arguments): 
+    """
+    Exports the headers of every dicom in the inprocess and processed exams, to
+    a gzipped CSV per exam in <exportdir> (see export).
+
+    Only the exams added or changed since the last export are read, unless
+    --all is given.
+    """
+    export_dir = arguments['<exportdir>']
+    examdirs   = []
+    for folder in [arguments['--inprocess-dir'], arguments['--processed-dir']]: 
+        if not os.path.isdir(folder): 
+            warn("Unable to read exams from {}. Skipping.".format(folder))
+            continue
+        examdirs.extend(sorted(path for path in listdir_fullpath(folder) 
+                               if os.path.isdir(path)))
+
+    exporter = export.Exporter(export_dir, int(arguments['-j']))
+    with metrics.phase("export_headers") as counts: 
+        exported = exporter.export(examdirs, everything = arguments['--all'])
+        counts["exams"] = len(exported)
+    log("Exported the headers of {} of {} exams to {}".format(
+        len(exported), len(examdirs), export_dir))
+
 def pfile_headers(path): 
     """ Dump out the headers for a pfile """
+    import pfiles
+    import tabulate
     headers = pfiles.get_pfile_headers(path)     
     if not headers: 
         warn("{} is not a pfile.".format(path))
@@ -692,6 +1574,26 @@ def pfile_headers(path):
     print tabulate.tabulate(table, headers= ["Header", "Value"])
     print
     
+####
+# Command registry
+###########################################
+
+# Maps each command to the function that runs it. Each function imports the
+# heavy modules it needs when it runs, so e.g. `mritool help` never loads
+# pydicom or pfile_tools.
+COMMANDS = [ 
+    ('pull',           pull_exams), 
+    ('check',          check_inprocess), 
+    ('complete',       package_exams), 
+    ('list-exams',     list_exams), 
+    ('list-inprocess', show_inprocess), 
+    ('list-series',    list_series), 
+    ('sync-exams',     sync), 
+    ('gc',             collect_garbage), 
+    ('export-headers', export_headers), 
+    ('pfile-headers',  lambda arguments: pfile_headers(arguments['<pfile>'])), 
+]
+
 def main(): 
     global VERBOSE
     global DEBUG
@@ -709,33 +1611,57 @@ def main():
 Finds and copies exam data into a well-organized folder structure.
 
 Usage: 
-    mritool [options] pull <exam> [<series>] [-o <outputdir>] [--bare]
-    mritool [options] check <exam>
-    mritool [options] complete <exam>
+    mritool [options] pull [<exam>] [<series>] [-b <booking_code>] [-d <date>] [-o <outputdir>] [--bare] [-j <jobs>] [--process=<names>] [--process-jobs=<num>]
+    mritool [options] check <exam> [--deep]
+    mritool [options] complete <exam> [--deep]
     mritool [options] list-exams [-b <booking_code>] [-e <exam>] [-d <date>]
     mritool [options] list-series <exam>
     mritool [options] list-inprocess
-    mritool [options] sync-exams [-e <exam>]
+    mritool [options] sync-exams [-e <exam>] [--order=<order>] [--limits=<limits>] [--state-dir=<dir>] [--process=<names>] [--process-jobs=<num>]
+    mritool [options] gc
+    mritool [options] export-headers <exportdir> [-j <jobs>] [--all]
     mritool pfile-headers <pfile>
     mritool help 
 
+<exam> can be a comma separated list of exams, for pull.
+
 Commands: 
-    pull                      Get an exam from the scanner
+    pull                      Get exams from the scanner
     check                     Check that an exam being processed has all of its files
     complete                  Mark an exam as complete by moving it to the processed folder
     list-exams                List all exams on the scanner
     list-series               List all series for the exam on the scanner
     list-inprocess            List the exams in the inprocess area
     sync-exams                Pulls all unpulled exams into the processing folder
+    gc                        Remove unused files from the object store, and report
+                              the space it saves
+    export-headers            Write the headers of every dicom in the inprocess and
+                              processed exams to a CSV (gzipped) per exam
     pfile-headers             Show the headers of a pfile
     help                      Display this help.
  
 Command options: 
     -b <bookingcode>          Booking code (StudyDescription)
-    -d <date>                 Date (StudyDate)
+    -d <date>                 Date (StudyDate), or range of dates for pull (<from>-<to>)
     -e <exam>                 Exam number (StudyID)
     -o <outputdir>            Output directory (overrides --inprocess-dir)
+    -j <jobs>                 Number of exams to pull (or processes to read 
+                              headers with) at once [default: 1]
     --bare                    Only pull dicom files
+    --all                     Export every exam, not only those changed since 
+                              the last export
+    --deep                    Also check each series' dicoms against the scanner's, 
+                              instance by instance
+    --order=<order>           Order for sync to pull exams in: scanner, newest,
+                              smallest, or booking:<code>,... [default: scanner]
+    --limits=<limits>         Exams for sync to pull at once by time of day,
+                              e.g. 07:00-19:00=1,19:00-07:00=4 (otherwise 1)
+    --state-dir=<dir>         Where sync keeps the state of exams (exams.db), e.g. on
+                              a volume shared by syncs on several hosts (otherwise
+                              --log-dir)
+    --process=<names>         Processors to run on pulled exams: spiral, nifti
+                              and/or qc (comma separated)
+    --process-jobs=<num>      Number of processing jobs to run at once [default: 2]
 
 Global options: 
     --inprocess-dir=<dir>     In-process exams directory [default: {defaults[inprocess]}]
@@ -746,9 +1672,20 @@ Global options:
     --port=<num>              Scanner port [default: {defaults[port]}]
     --aet=<str>               Scanner AET [default: {defaults[aet]}]
     --aec=<str>               Calling machine AEC [default: {defaults[aec]}]
+    --return-port=<num>       Port to receive dicoms on (otherwise --port)
+    --scanners=<file>         Scanner config file, with a section per scanner, for 
+                              sync-exams and list-exams to work on every scanner
     -f, --force               Force a command, even if there are warnings
     -v, --verbose             Verbose messages
     --debug                   Debug messages 
+    --transfer=<syntax>       Transfer syntax to accept from the scanner: uncompressed, 
+                              jpeg-ls, j2k, rle or jpeg-lossless (all lossless) 
+                              [default: uncompressed]
+    --compress=<codec>        Store dicoms compressed losslessly: jpeg-ls, rle or 
+                              jpeg-lossless
+    --object-store=<dir>      Store files once, by content, in <dir> and hardlink 
+                              them into exam folders (same filesystem) 
+    --profile=<file>          Write cProfile stats for the command to <file>
 """.format(defaults=defaults)
 
     arguments = docopt(options)
@@ -760,25 +1697,25 @@ Global options:
 
     if DEBUG: 
         logger.setLevel(logging.DEBUG)
-    
-    if arguments['pull']:
-        pull_exams(arguments)
-    if arguments['check']:
-        check_inprocess(arguments)
-    if arguments['complete']:
-        package_exams(arguments)
-    if arguments['list-exams']:
-        list_exams(arguments)
-    if arguments['list-inprocess']:
-        show_inprocess(arguments)
-    if arguments['list-series']:
-        list_series(arguments)
-    if arguments['sync-exams']:
-        sync(arguments)
-    if arguments['pfile-headers']:
-        pfile_headers(arguments['<pfile>'])
+
+    if arguments['--profile']: 
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(run_command, arguments, options)
+        profiler.dump_stats(arguments['--profile'])
+        log("Wrote profile to {}".format(arguments['--profile']))
+    else: 
+        run_command(arguments, options)
+
+def run_command(arguments, options): 
+    """ Run the command given on the command line. """
     if arguments['help']: 
         print options
-    
+        return
+
+    for command, func in COMMANDS: 
+        if arguments[command]: 
+            func(arguments)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,57 @@
+"""
+Compress is a module that wraps DCMTK's lossless compression tools (dcmcjpls, dcmcrle and dcmcjpeg).
+
+Dicoms are recompressed in place, so that they can be stored compressed in the exam folders without changing how they
+are named or found.
+"""
+
+import os
+import logging
+import subprocess
+
+log = logging.getLogger('mritool.compress')
+
+# codec -> (DCMTK command, transfer syntax it writes)
+CODECS = {
+    'jpeg-ls': ('dcmcjpls', '1.2.840.10008.1.2.4.80'),
+    'rle': ('dcmcrle', '1.2.840.10008.1.2.5'),
+    'jpeg-lossless': ('dcmcjpeg', '1.2.840.10008.1.2.4.70'),
+}
+
+UNCOMPRESSED = set([
+    '1.2.840.10008.1.2',        # implicit VR little endian
+    '1.2.840.10008.1.2.1',      # explicit VR little endian
+    '1.2.840.10008.1.2.2',      # explicit VR big endian
+])
+
+
+def transfer_syntax(ds):
+    """Return the transfer syntax UID of a dataset read from a file, or None."""
+    meta = getattr(ds, 'file_meta', None)
+    return meta and meta.get('TransferSyntaxUID') or None
+
+
+def compress(path, codec, syntax=None):
+    """
+    Recompress the dicom at path losslessly with codec (see CODECS), in place.
+
+    syntax is the transfer syntax the file is in, if known. Files that are already compressed are left as they are.
+    Returns True if the file was recompressed. Raises OSError if the DCMTK command isn't installed, and
+    subprocess.CalledProcessError if it fails.
+    """
+    if codec not in CODECS:
+        raise ValueError('Unknown codec %s. Expected one of: %s' % (codec, ', '.join(sorted(CODECS))))
+    if syntax and syntax not in UNCOMPRESSED:
+        return False
+
+    command, _ = CODECS[codec]
+    compressed = path + '.compressing'
+    try:
+        cmd = [command, path, compressed]
+        log.debug(' '.join(cmd))
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        os.rename(compressed, path)
+    finally:
+        if os.path.exists(compressed):
+            os.remove(compressed)
+    return True
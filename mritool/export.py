@@ -0,0 +1,158 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Exports the headers of every image in the exam folders, for analysis in bulk.
+
+Each exam is written to <output_dir>/<exam folder>.csv.gz, with a row per dicom
+and a column per header in COLUMNS. The headers are read (without the pixel
+data) on a pool of processes.
+
+A manifest (<output_dir>/manifest.json) records the modification times of the
+folders of each exam exported, so that later exports only read the exams that
+have been added or changed since (a dicom added, removed or replaced changes the
+mtime of its series folder, and an exam moved to another folder is exported
+again with its new paths). Only the folders are stat'ed to check an exam; its
+dicoms are listed and read only if it has changed. The manifest is saved every
+MANIFEST_EVERY exams, and when the export ends, so an interrupted export redoes
+at most that many exams. Exams whose folders no longer exist are dropped from
+the manifest when it is saved.
+"""
+import os
+import csv
+import gzip
+import json
+import logging
+import multiprocessing
+
+log = logging.getLogger('mritool.export')
+
+COLUMNS = ["StudyID", "StudyDate", "StudyDescription", "PatientID",
+           "SeriesNumber", "SeriesDescription", "ProtocolName",
+           "InstanceNumber", "SOPInstanceUID", "AcquisitionDate",
+           "AcquisitionTime", "ContentTime", "RepetitionTime", "EchoTime",
+           "InversionTime", "FlipAngle", "SliceThickness", "SpacingBetweenSlices",
+           "Rows", "Columns", "PixelSpacing", "ImagesInAcquisition",
+           "MagneticFieldStrength", "ScanningSequence", "SequenceVariant"]
+
+MANIFEST = "manifest.json"
+MANIFEST_EVERY = 100    # exams to export between saves of the manifest
+
+def read_row(path):
+    """
+    Reads the headers of the dicom at <path>.
+
+    Returns its row: the path, then a value for each of COLUMNS ("" if it isn't
+    in the headers). Returns None if the file isn't a dicom.
+    """
+    import dicom
+    try:
+        ds = dicom.read_file(path, stop_before_pixels = True)
+    except dicom.filereader.InvalidDicomError:
+        return None
+    return [path] + [_text(ds.get(column)) for column in COLUMNS]
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):    # multi-valued, e.g. PixelSpacing
+        return "\\".join(str(v) for v in value)
+    return str(value)
+
+def exam_signature(examdir):
+    """
+    Returns the signature of an exam: the mtimes of the exam folder (".") and of
+    each of its series folders, by name.
+
+    Only the exam folder is listed; the series folders are just stat'ed.
+    """
+    signature = { "." : os.stat(examdir).st_mtime }
+    for name in os.listdir(examdir):
+        seriesdir = os.path.join(examdir, name)
+        if os.path.isdir(seriesdir):
+            signature[name] = os.stat(seriesdir).st_mtime
+    return signature
+
+def exam_files(examdir, signature):
+    """ Returns the dicoms (*.dcm) in the series folders of an exam's signature. """
+    files = []
+    for name in sorted(signature):
+        if name == ".": continue
+        seriesdir = os.path.join(examdir, name)
+        files.extend(os.path.join(seriesdir, f)
+                     for f in sorted(os.listdir(seriesdir)) if f.endswith(".dcm"))
+    return files
+
+class Exporter(object):
+    """
+    Exports the headers of exams to <output_dir>, reading them on <jobs>
+    processes.
+    """
+
+    def __init__(self, output_dir, jobs = 1):
+        self.output_dir = output_dir
+        self.jobs       = jobs
+        self.manifest   = {}
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        if os.path.exists(self.path(MANIFEST)):
+            with open(self.path(MANIFEST)) as f:
+                self.manifest = json.load(f)
+
+    def path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def export(self, examdirs, everything = False):
+        """
+        Exports each exam in <examdirs> that has changed since it was last
+        exported (or all of them, if <everything> is set).
+
+        Returns the names of the exams exported.
+        """
+        exported = []
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            for examdir in examdirs:
+                name = os.path.basename(os.path.normpath(examdir))
+                signature = exam_signature(examdir)
+                last = self.manifest.get(name, {})
+                if not everything and last.get("path") == examdir \
+                        and last.get("signature") == signature:
+                    continue
+                files = exam_files(examdir, signature)
+                if not files: continue
+                rows = [row for row in pool.imap(read_row, files, chunksize = 16)
+                        if row]
+                self._write(name + ".csv.gz", rows)
+                self.manifest[name] = { "path" : examdir, "signature" : signature,
+                                        "images" : len(rows) }
+                log.debug("Exported {} headers of {}".format(len(rows), examdir))
+                exported.append(name)
+                if len(exported) % MANIFEST_EVERY == 0:
+                    self._save_manifest()
+        finally:
+            pool.close()
+            pool.join()
+            if exported:
+                self._save_manifest()
+        return exported
+
+    def _write(self, name, rows):
+        """ Writes rows to a gzipped CSV, replacing any file of that name. """
+        partial = self.path(name + ".partial")
+        out = gzip.open(partial, "wb")
+        try:
+            writer = csv.writer(out)
+            writer.writerow(["path"] + COLUMNS)
+            writer.writerows(rows)
+        finally:
+            out.close()
+        os.rename(partial, self.path(name))
+
+    def _save_manifest(self):
+        """ Saves the manifest, dropping the exams whose folders are gone. """
+        for name, entry in self.manifest.items():
+            if not os.path.isdir(entry["path"]):
+                del self.manifest[name]
+        partial = self.path(MANIFEST + ".partial")
+        with open(partial, "w") as f:
+            json.dump(self.manifest, f, sort_keys = True)
+        os.rename(partial, self.path(MANIFEST))
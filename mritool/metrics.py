@@ -0,0 +1,88 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Records how long each phase of a command takes, as JSON lines.
+
+Phases are timed with the measured() decorator or the phase() context manager,
+and tagged with the exam being worked on (see exam()). Nothing is written until
+a metrics file is configured with configure().
+"""
+import os
+import json
+import time
+import datetime
+import functools
+import threading
+import contextlib
+
+_lock    = threading.Lock()
+_context = threading.local()
+_path    = None
+
+def configure(path):
+    """ Append metrics to the file at <path>. None turns recording off. """
+    global _path
+    _path = path
+
+def record(phase, seconds, **counts):
+    """ Write a metrics record for a phase of the current exam. """
+    if not _path: return
+    entry = { "time"    : datetime.datetime.now().isoformat(),
+              "pid"     : os.getpid(),
+              "exam"    : getattr(_context, "exam", None),
+              "phase"   : phase,
+              "seconds" : round(seconds, 6) }
+    entry.update(counts)
+    with _lock:
+        with open(_path, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+@contextlib.contextmanager
+def exam(examid):
+    """ Tag the metrics recorded by this thread with <examid>. """
+    previous = getattr(_context, "exam", None)
+    _context.exam = examid
+    try:
+        yield
+    finally:
+        _context.exam = previous
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Time a block of code as a phase.
+
+    Yields a dictionary that the block can fill with counts (e.g. files,
+    bytes) to be recorded along with the time.
+    """
+    counts = {}
+    start  = time.time()
+    try:
+        yield counts
+    finally:
+        record(name, time.time() - start, **counts)
+
+def measured(name, summarize = None):
+    """
+    Decorator that times each call of a function as a phase.
+
+    <summarize> is given the function's return value, and returns a dictionary
+    of counts to record with the time. Neither happens unless a metrics file is
+    configured.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _path:
+                return func(*args, **kwargs)
+            with phase(name) as counts:
+                result = func(*args, **kwargs)
+                if summarize: counts.update(summarize(result))
+            return result
+        return wrapper
+    return decorator
+
+def file_operations(ops):
+    """ Summarize a list of (source, dest) file operations. """
+    return { "files" : len(ops),
+             "bytes" : sum(os.path.getsize(source) for source, dest in ops
+                           if os.path.exists(source)) }
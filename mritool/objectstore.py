@@ -0,0 +1,185 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Stores files once by their content, and hardlinks them into exam folders.
+
+Each distinct file is kept as <root>/objects/<ab>/<rest of sha1>, read-only.
+Placing a file whose content is already stored costs only a link, so re-pulls,
+overlapping series pulls and pfiles copied into several exams take no more
+space. An object that is no longer linked from anywhere else (a link count of
+1) is garbage, and is removed by gc(). gc() locks the store (<root>/lock, with
+flock) against adding and placing files from any process, so that it can't
+remove an object between a check that it is stored and the link to it.
+
+The store must be on the same filesystem as the exam folders, since hardlinks
+can't cross filesystems. Files that can't be linked are copied as usual.
+"""
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+CHUNK = 1024 * 1024
+
+def digest(path):
+    """ Returns the sha1 of the contents of the file at <path>. """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK), ""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class ObjectStore(object):
+    """ A store of files, kept in <root> by content. """
+
+    def __init__(self, root):
+        self.root    = root
+        self.objects = os.path.join(root, "objects")
+        self.tmp     = os.path.join(root, "tmp")
+        self.lock    = threading.Lock()     # for threads; flock for processes
+        for folder in (self.objects, self.tmp):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+    def path(self, key):
+        """ Returns the path of the object with the given sha1. """
+        return os.path.join(self.objects, key[:2], key[2:])
+
+    def add(self, path):
+        """
+        Stores the file at <path>, and replaces it with a link to the stored
+        object. If the same content is already stored, the file is replaced by a
+        link to that, and its space is freed.
+
+        Returns the object's key, or None if the file couldn't be linked.
+        """
+        key = digest(path)
+        obj = self.path(key)
+        try:
+            with self._locked():
+                if not os.path.exists(obj):
+                    self._make_folder(obj)
+                    try:
+                        os.link(path, obj)
+                        _read_only(obj)
+                        return key
+                    except OSError as ex:   # unless another sync stored it
+                        if ex.errno != errno.EEXIST: raise
+                if not os.path.samefile(obj, path):
+                    self._link(obj, path)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV: raise
+            return None
+        return key
+
+    def place(self, source, dest):
+        """
+        Copies the file at <source> to <dest> by way of the store: the content
+        is copied into the store only if it isn't already there, and <dest> is
+        a link to the stored object.
+
+        Returns True if <dest> is a link to an object that was already stored.
+        """
+        key = digest(source)
+        obj = self.path(key)
+        with self._locked():
+            stored = os.path.exists(obj)
+            try:
+                if not stored:
+                    self._make_folder(obj)
+                    fd, copy = tempfile.mkstemp(dir = self.tmp)
+                    os.close(fd)
+                    shutil.copyfile(source, copy)
+                    _read_only(copy)
+                    os.rename(copy, obj)
+                self._link(obj, dest)
+            except OSError as ex:
+                if ex.errno != errno.EXDEV: raise
+                shutil.copyfile(source, dest)
+        return stored
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive = False):
+        """
+        Locks the store for this thread, and for this process against others:
+        shared to add and place files, which may run at once, or exclusive to
+        collect garbage.
+        """
+        with self.lock:
+            with open(os.path.join(self.root, "lock"), "a") as f:
+                fcntl.flock(f, exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+                yield
+
+    def _link(self, obj, dest):
+        """ Links <dest> to <obj>, replacing anything at <dest>. """
+        fd, link = tempfile.mkstemp(dir = os.path.dirname(dest) or ".",
+                prefix = ".link-")
+        os.close(fd)
+        os.remove(link)
+        os.link(obj, link)
+        os.rename(link, dest)
+
+    def _make_folder(self, obj):
+        if not os.path.exists(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj))
+
+    def __iter__(self):
+        """ Yields the path and os.stat() of each stored object. """
+        for folder in sorted(os.listdir(self.objects)):
+            folder = os.path.join(self.objects, folder)
+            for name in sorted(os.listdir(folder)):
+                path = os.path.join(folder, name)
+                yield path, os.stat(path)
+
+    def usage(self):
+        """
+        Returns a dictionary describing how much space the store saves:
+
+            objects       the number of stored objects
+            links         the number of links to them from outside the store
+            stored        bytes the objects take up
+            linked        bytes the links would take up, as separate files
+            saved         bytes saved by linking (linked - stored, for objects
+                          that are linked)
+            garbage       bytes of objects nothing links to
+        """
+        usage = dict.fromkeys(["objects", "links", "stored", "linked", "saved",
+            "garbage"], 0)
+        for path, st in self:
+            links = st.st_nlink - 1
+            usage["objects"] += 1
+            usage["links"]   += links
+            usage["stored"]  += st.st_size
+            usage["linked"]  += st.st_size * links
+            if links:
+                usage["saved"]   += st.st_size * (links - 1)
+            else:
+                usage["garbage"] += st.st_size
+        return usage
+
+    def gc(self):
+        """
+        Removes the objects that nothing outside the store links to.
+
+        Returns the number of objects and bytes removed.
+        """
+        count, size = 0, 0
+        with self._locked(exclusive = True):
+            for path, st in self:
+                if st.st_nlink > 1: continue
+                os.remove(path)
+                count += 1
+                size  += st.st_size
+            for folder in os.listdir(self.objects):
+                folder = os.path.join(self.objects, folder)
+                if not os.listdir(folder):
+                    os.rmdir(folder)
+        return count, size
+
+def _read_only(path):
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
@@ -0,0 +1,204 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Processes exams after they are pulled: reconstructs spiral pfiles, converts
+dicoms to NIfTI, and summarizes each series for QC.
+
+Processors are registered with @processor, and are chosen for each series
+folder of an exam by its SeriesDescription, or by whether the series has a
+pfile (its presscsi flag). A ProcessingPool runs them on a pool of processes,
+so that processing one exam doesn't hold up pulling the next.
+"""
+import os
+import re
+import glob
+import json
+import fnmatch
+import logging
+import subprocess
+import multiprocessing
+
+log = logging.getLogger('mritool.processing')
+
+PRESSCSI_KEY = 0x0019109e       # as DICOM_PRESSCI_KEY in command_line
+
+# Command that reconstructs a spiral pfile (fmriutil's grecons), given the
+# pfile's name. Run in the series folder.
+SPIRAL_RECON = os.environ.get("MRITOOL_SPIRAL_RECON", "grecons")
+
+PROCESSORS = {}     # name -> Processor
+
+QUEUED = 'queued'   # statuses of processing jobs, as in state
+DONE   = 'done'
+FAILED = 'failed'
+
+class Processor(object):
+    """
+    A function to run on series folders, with the SeriesDescription (a
+    case-insensitive wildcard pattern) of the series it applies to. If
+    <presscsi> is set, it only applies to series with the presscsi flag.
+    """
+
+    def __init__(self, name, func, series = "*", presscsi = False):
+        self.name     = name
+        self.func     = func
+        self.series   = series
+        self.presscsi = presscsi
+
+    def matches(self, headers):
+        if self.presscsi and not headers.get("presscsi"):
+            return False
+        return fnmatch.fnmatch((headers.get("SeriesDescription") or "").lower(),
+                self.series.lower())
+
+def processor(name, series = "*", presscsi = False):
+    """
+    Decorator that registers a processor.
+
+    The function is called with the series folder and a dictionary of the
+    series' headers (see series_headers). It may return a message to record.
+    """
+    def register(func):
+        PROCESSORS[name] = Processor(name, func, series, presscsi)
+        return func
+    return register
+
+def series_headers(ds):
+    """ Returns the headers of a dicom that processors need, as a dictionary. """
+    headers = { key : ds.get(key) for key in ["StudyID", "SeriesNumber",
+        "SeriesDescription", "ImagesInAcquisition"] }
+    headers["presscsi"] = PRESSCSI_KEY in ds and \
+            ds[PRESSCSI_KEY].value == "presscsi"
+    return { key : value if isinstance(value, (bool, type(None))) else str(value)
+             for key, value in headers.items() }
+
+def plan(names, dicom_info):
+    """
+    Returns the (processor name, series folder, headers) jobs for an exam.
+
+    <names> are the processors to run, and <dicom_info> maps a dicom per series
+    folder to its headers (see command_line.Receiver.headers).
+    """
+    jobs = []
+    for dicompath, ds in sorted(dicom_info.items()):
+        headers = series_headers(ds)
+        for name in names:
+            if PROCESSORS[name].matches(headers):
+                jobs.append((name, os.path.dirname(dicompath), headers))
+    return jobs
+
+def run(name, seriesdir, headers):
+    """
+    Runs a processor on a series folder.
+
+    Returns (name, seriesdir, error, message): error is None if it succeeded.
+    """
+    try:
+        message = PROCESSORS[name].func(seriesdir, headers)
+        return name, seriesdir, None, message
+    except subprocess.CalledProcessError as ex:
+        return name, seriesdir, "{} failed: {}".format(ex.cmd, ex.output), None
+    except Exception as ex:
+        return name, seriesdir, "{}: {}".format(type(ex).__name__, ex), None
+
+class ProcessingPool(object):
+    """
+    Runs processors on pulled exams, on a pool of <jobs> processes.
+
+    <names> are the processors to run. on_status(examid, name, seriesdir,
+    status, message) is called (in this process) as each job is queued, and as
+    it finishes. Create the pool before starting any threads, since its
+    processes are forked.
+    """
+
+    def __init__(self, names, jobs = 2, on_status = None):
+        unknown = [name for name in names if name not in PROCESSORS]
+        if unknown:
+            raise ValueError("Unknown processors: {}. Expected: {}".format(
+                ", ".join(unknown), ", ".join(sorted(PROCESSORS))))
+        self.names     = names
+        self.on_status = on_status
+        self.pool      = multiprocessing.Pool(jobs)
+
+    def submit(self, examid, dicom_info):
+        """ Queues the processing of an exam. Returns the number of jobs. """
+        jobs = plan(self.names, dicom_info)
+        for name, seriesdir, headers in jobs:
+            self._status(examid, name, seriesdir, QUEUED)
+            self.pool.apply_async(run, (name, seriesdir, headers),
+                    callback = lambda result, examid = examid:
+                        self._done(examid, *result))
+        return len(jobs)
+
+    def _done(self, examid, name, seriesdir, error, message):
+        if error:
+            log.warning("Processor {} failed for {}: {}".format(name, seriesdir,
+                error))
+        self._status(examid, name, seriesdir, error and FAILED or DONE,
+                error or message)
+
+    def _status(self, examid, name, seriesdir, status, message = None):
+        if not self.on_status: return
+        try:
+            self.on_status(examid, name, seriesdir, status, message)
+        except Exception as ex:
+            log.warning("Unable to record processing of {}: {}".format(
+                seriesdir, ex))
+
+    def close(self):
+        """ Waits for all queued processing to finish. """
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """ Stops the processes at once, dropping the processing queued. """
+        self.pool.terminate()
+        self.pool.join()
+
+def _command(cmd, cwd):
+    log.debug(" ".join(cmd))
+    return subprocess.check_output(cmd, cwd = cwd, stderr = subprocess.STDOUT)
+
+####
+# Processors
+###########################################
+
+@processor("spiral", series = "*spiral*")
+def spiral_recon(seriesdir, headers):
+    """ Reconstructs the spiral pfiles in a series with fmriutil. """
+    pfiles = sorted(glob.glob(os.path.join(seriesdir, "*.7")))
+    if not pfiles:
+        return "No pfiles to reconstruct"
+    for pfile in pfiles:
+        _command([SPIRAL_RECON, os.path.basename(pfile)], seriesdir)
+    return "Reconstructed {} pfiles".format(len(pfiles))
+
+@processor("nifti")
+def dicom_to_nifti(seriesdir, headers):
+    """ Converts the dicoms in a series to NIfTI (and a JSON sidecar) with dcm2niix. """
+    _command(["dcm2niix", "-z", "y", "-b", "y", "-f", os.path.basename(seriesdir),
+        "-o", seriesdir, seriesdir], seriesdir)
+
+@processor("qc")
+def qc_summary(seriesdir, headers):
+    """
+    Writes qc.json in a series folder: the number of images received and
+    expected, the instance numbers missing, and the pfiles present.
+    """
+    instances = []
+    for name in os.listdir(seriesdir):
+        match = re.match(r".*Im(\d+)\.dcm$", name)
+        if match:
+            instances.append(int(match.group(1)))
+    expected = int(headers.get("ImagesInAcquisition") or 0) or \
+            max(instances or [0])
+    summary = { "series"   : headers.get("SeriesNumber"),
+                "description" : headers.get("SeriesDescription"),
+                "images"   : len(instances),
+                "expected" : expected,
+                "missing"  : sorted(set(range(1, expected + 1)) - set(instances)),
+                "pfiles"   : sorted(os.path.basename(p) for p in
+                                    glob.glob(os.path.join(seriesdir, "*.7"))) }
+    with open(os.path.join(seriesdir, "qc.json"), "w") as f:
+        json.dump(summary, f, indent = 2, sort_keys = True)
+    if summary["missing"]:
+        return "{} of {} images missing".format(len(summary["missing"]), expected)
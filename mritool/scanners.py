@@ -0,0 +1,79 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Reads the scanner config file given with --scanners.
+
+The file has a section per scanner, named for the scanner, e.g.
+
+    [mr750]
+    host          = CAMHMR
+    port          = 4006
+    aet           = mrsrv1
+    aec           = CAMHMR
+    pfile_dir     = /mnt/GE/camh
+    limits        = 07:00-19:00=1,19:00-07:00=4
+
+Each key overrides the command line option of the same name (with dashes for
+underscores), for that scanner only. Each scanner keeps its logs and sync state
+in a folder of its own, <--log-dir>/<name> (or <--state-dir>/<name>) unless
+log_dir (or state_dir) is given.
+
+The exams.txt of a sync from before --scanners (<--log-dir>/exams.txt) is
+imported by the scanner it was kept for: the one with the host, port and aet of
+the command line, or else the first. A sync state database (exams.db) from
+before --scanners isn't: move it to the folder of its scanner before the first
+sync with --scanners, or that scanner's exams are pulled again.
+"""
+import os
+import ConfigParser
+
+KEYS = ["host", "port", "return_port", "aet", "aec", "pfile_dir",
+        "inprocess_dir", "processed_dir", "log_dir", "state_dir", "order",
+        "limits", "transfer", "compress", "object_store", "process",
+        "process_jobs"]
+
+class ConfigError(ValueError):
+    pass
+
+def read_scanners(path, arguments):
+    """
+    Reads the scanner config file at <path>.
+
+    Returns a list of (name, arguments) for each scanner, where arguments are a
+    copy of the command line <arguments> with the scanner's settings applied.
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(path):
+        raise ConfigError("Unable to read scanner config file {}".format(path))
+    if not config.sections():
+        raise ConfigError("No scanners are listed in {}".format(path))
+
+    scanners = []
+    for name in config.sections():
+        settings = dict(arguments)
+        settings['--scanners'] = None
+        settings['--log-dir']  = os.path.join(arguments['--log-dir'], name)
+        if arguments['--state-dir']:
+            settings['--state-dir'] = os.path.join(arguments['--state-dir'], name)
+        for key, value in config.items(name):
+            if key not in KEYS:
+                raise ConfigError("Unknown setting {} for scanner {} in {}. "
+                        "Expected one of: {}".format(key, name, path,
+                        ", ".join(KEYS)))
+            settings["--" + key.replace("_", "-")] = value
+        scanners.append((name, settings))
+
+    options = ['--host', '--port', '--aet']
+    former  = [settings for name, settings in scanners
+               if all(settings[o] == arguments[o] for o in options)]
+    settings = (former or [scanners[0][1]])[0]
+    settings['--exams-txt'] = os.path.join(arguments['--log-dir'], "exams.txt")
+
+    ports = {}
+    for name, settings in scanners:
+        port = settings.get('--return-port') or settings['--port']
+        if port in ports:
+            raise ConfigError("Scanners {} and {} would both receive dicoms on "
+                    "port {}. Give each a return_port of its own.".format(
+                    ports[port], name, port))
+        ports[port] = name
+    return scanners
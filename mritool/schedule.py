@@ -0,0 +1,180 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Decides the order exams are pulled in by sync, and how many at once.
+
+Exams are ordered by a priority (see order_exams), and pulled with as many
+running at once as the limits for the current time of day allow, e.g. one at a
+time while the scanner is busy during the day and four at a time overnight. A
+batch is limited to the exams that fit in the space free (see fit_space).
+"""
+import re
+import fnmatch
+import datetime
+import threading
+
+ORDERS = ["scanner", "newest", "smallest", "booking:<code>[,<code>...]"]
+
+IMAGE_BYTES = 600 * 1024    # bytes to expect per image until some are pulled
+
+class ScheduleError(ValueError):
+    pass
+
+def parse_limits(text):
+    """
+    Parses time window limits, e.g. "07:00-19:00=1,19:00-07:00=4".
+
+    Returns a list of (start, end, jobs) with start and end as datetime.time.
+    A window may wrap past midnight. A limit of 0 pauses pulling.
+    """
+    limits = []
+    for window in filter(None, (text or "").split(",")):
+        match = re.match(r"^\s*(\d\d?):(\d\d)-(\d\d?):(\d\d)=(\d+)\s*$", window)
+        if not match:
+            raise ScheduleError("Can't understand limit {!r}. Expected "
+                    "<HH:MM>-<HH:MM>=<jobs>".format(window))
+        h1, m1, h2, m2, jobs = [int(g) for g in match.groups()]
+        limits.append((datetime.time(h1, m1), datetime.time(h2, m2), jobs))
+    return limits
+
+def in_window(start, end, t):
+    if start <= end:
+        return start <= t < end
+    return t >= start or t < end
+
+def booking_code(exam):
+    """ Returns an exam's booking code, without any amendment marker. """
+    code = exam.get("StudyDescription") or ""
+    if code.split(" ")[0].startswith("e+"):
+        code = " ".join(code.split(" ")[1:])
+    return code
+
+def order_exams(exams, order, sizes = None):
+    """
+    Returns exams in the order they should be pulled.
+
+    <order> is one of:
+        scanner                   as the scanner listed them
+        newest                    most recent exams first
+        smallest                  fewest images first (<sizes> maps StudyID
+                                  to the number of images in the exam)
+        booking:<code>,...        exams with these booking codes first, in the
+                                  order given (codes may use wildcards)
+    """
+    order = order or "scanner"
+    if order == "scanner":
+        return list(exams)
+    if order == "newest":
+        return sorted(exams, reverse = True, key = lambda exam:
+                (exam.get("StudyDate") or "", int(exam.get("StudyID") or 0)))
+    if order == "smallest":
+        sizes = sizes or {}
+        return sorted(exams, key = lambda exam: sizes.get(exam.get("StudyID"), 0))
+    if order.startswith("booking:"):
+        codes = filter(None, order[len("booking:"):].split(","))
+        def rank(exam):
+            for i, code in enumerate(codes):
+                if fnmatch.fnmatch(booking_code(exam), code):
+                    return i
+            return len(codes)
+        return sorted(exams, key = rank)
+    raise ScheduleError("Unknown order {!r}. Expected one of: {}".format(
+        order, ", ".join(ORDERS)))
+
+def drain_time(images, rate, jobs = 1):
+    """
+    Estimates how long pulling <images> will take at <rate> images per second
+    per job. Returns a timedelta, or None if there is no rate to go by.
+    """
+    if not rate or not jobs:
+        return None
+    return datetime.timedelta(seconds = int(images / (rate * jobs)))
+
+def estimate_bytes(images, bytes_per_image = None):
+    """
+    Estimates the bytes <images> will take up, at <bytes_per_image> (as learned
+    from past pulls) or IMAGE_BYTES.
+    """
+    return images * (bytes_per_image or IMAGE_BYTES)
+
+def fit_space(exams, sizes, space):
+    """
+    Splits exams (in order) into those that fit in <space> bytes together, and
+    those left over. <sizes> maps StudyID to the estimated bytes of the exam.
+
+    An exam that doesn't fit is passed over for later ones that do.
+    """
+    fits, left = [], []
+    for exam in exams:
+        size = sizes.get(exam.get("StudyID"), 0)
+        if size <= space:
+            fits.append(exam)
+            space -= size
+        else:
+            left.append(exam)
+    return fits, left
+
+class Scheduler(object):
+    """
+    Runs work on items in order, with at most as many at once as the limits
+    for the current time allow.
+
+    <limits> are as returned by parse_limits(). Outside of every window,
+    <default_jobs> run at once.
+    """
+
+    def __init__(self, limits, default_jobs = 1, poll = 30):
+        self.limits       = limits
+        self.default_jobs = default_jobs
+        self.poll         = poll
+        self.condition    = threading.Condition()
+
+    def jobs(self, when = None):
+        """ Returns how many items may be worked on at once at <when>. """
+        t = (when or datetime.datetime.now()).time()
+        for start, end, jobs in self.limits:
+            if in_window(start, end, t):
+                return jobs
+        return self.default_jobs
+
+    def max_jobs(self):
+        return max([self.default_jobs] + [jobs for _, _, jobs in self.limits])
+
+    def run(self, items, work, on_done = None):
+        """
+        Calls work(item) for each item, in order, each on its own thread.
+
+        on_done(item, remaining) is called as each item finishes. If the limit
+        drops to 0 while nothing is running, stops and returns the items that
+        were not started.
+        """
+        queue   = list(items)
+        running = []
+        errors  = []
+
+        def worker(item):
+            try:
+                work(item)
+                if on_done: on_done(item, list(queue))
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                with self.condition:
+                    running.remove(item)
+                    self.condition.notify_all()
+
+        with self.condition:
+            while queue or running:
+                limit = self.jobs()
+                if limit == 0 and not running:
+                    break
+                while queue and len(running) < limit:
+                    item = queue.pop(0)
+                    running.append(item)
+                    thread = threading.Thread(target = worker, args = (item,))
+                    thread.daemon = True
+                    thread.start()
+                self.condition.wait(self.poll)
+
+        if errors:
+            raise errors[0]
+        return queue
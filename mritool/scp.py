@@ -0,0 +1,124 @@
+"""
+SCP is a module that wraps the storescp command, which is part of DCMTK.
+
+A StorageSCP runs storescp in the background so that it can be the destination
+of C-MOVE requests made with SCU.move(). Each file is handed to a callback as
+soon as storescp has finished writing it, so that callers can file images while
+the rest of the transfer is still in progress.
+"""
+
+import os
+import time
+import shlex
+import socket
+import logging
+import threading
+import subprocess
+
+log = logging.getLogger('mritool.scp')
+
+RECEIVED_MARKER = 'MRITOOL-RECEIVED'
+
+# transfer syntax -> storescp option that prefers it when the sender offers it
+TRANSFER_SYNTAXES = {
+    'uncompressed': '',
+    'jpeg-lossless': '+xs',
+    'jpeg-ls': '+xt',
+    'j2k': '+xv',
+    'rle': '+xr',
+}
+
+
+class StorageSCP(object):
+
+    """
+    StorageSCP receives images into a spool directory and calls on_receive(path) for each one.
+
+    Instantiated with the port to listen on and the aet that the scanner knows this machine by. Use as a context
+    manager, or call start() and stop() around the C-MOVE. With fork=True, storescp handles each association in its
+    own process, so that several C-MOVEs can deliver at once.
+
+    The scanner proposes the transfer syntaxes it can send, and storescp picks one. With transfer_syntax set to one of
+    TRANSFER_SYNTAXES, storescp accepts that (lossless) compressed syntax first, and falls back to uncompressed.
+    """
+
+    def __init__(self, port, aet, spool_dir, on_receive, timeout=10, fork=False, transfer_syntax=None):
+        if (transfer_syntax or 'uncompressed') not in TRANSFER_SYNTAXES:
+            raise ValueError('Unknown transfer syntax %s. Expected one of: %s' % (
+                transfer_syntax, ', '.join(sorted(TRANSFER_SYNTAXES))))
+        self.port = port
+        self.aet = aet
+        self.spool_dir = spool_dir
+        self.on_receive = on_receive
+        self.timeout = timeout
+        self.fork = fork
+        self.transfer_syntax = transfer_syntax or 'uncompressed'
+        self.process = None
+        self.reader = None
+        self.received = 0
+
+    def start(self):
+        """Start storescp and the thread that reads its reception notices."""
+        preference = TRANSFER_SYNTAXES[self.transfer_syntax]
+        cmd = 'storescp %s%s--aetitle %s --output-directory "%s" --exec-sync --exec-on-reception "echo %s #p/#f" %s' % (
+            self.fork and '--fork ' or '', preference and preference + ' ' or '', self.aet, self.spool_dir,
+            RECEIVED_MARKER, str(self.port))
+        log.debug(cmd)
+        self.process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.reader = threading.Thread(target=self._read_notices)
+        self.reader.daemon = True
+        self.reader.start()
+        try:
+            self._wait_until_listening()
+        except RuntimeError:
+            self.stop()
+            raise
+
+    def stop(self):
+        """Stop storescp, and hand over any files that arrived without a notice."""
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+        if self.process:
+            self.process.wait()
+        if self.reader:
+            self.reader.join()
+        for (path, dirs, files) in os.walk(self.spool_dir):
+            for f in files:
+                self._receive(os.path.join(path, f))
+
+    def _wait_until_listening(self):
+        """Wait for storescp to accept connections, so a C-MOVE isn't refused."""
+        deadline = time.time() + self.timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError('storescp exited with status %s' % self.process.returncode)
+            try:
+                socket.create_connection(('localhost', int(self.port)), 1).close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    raise RuntimeError('storescp is not listening on port %s' % self.port)
+                time.sleep(0.05)
+
+    def _read_notices(self):
+        for line in iter(self.process.stdout.readline, ''):
+            if line.startswith(RECEIVED_MARKER):
+                self._receive(line[len(RECEIVED_MARKER):].strip())
+            else:
+                log.debug(line.rstrip())
+
+    def _receive(self, path):
+        if not os.path.exists(path):
+            return
+        self.received += 1
+        try:
+            self.on_receive(path)
+        except Exception as ex:
+            log.warning('Unable to handle received file %s: %s' % (path, ex))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
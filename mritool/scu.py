@@ -9,13 +9,22 @@ and data source, respectively).
 
 Specific Query objects are constructed (e.g., SeriesQuery, if you intend to search for or move a series) and passed to
 the find() or move() methods of an SCU object.
+
+find_async() and move_async() start the same calls in the background and return an Operation at once, so that several
+exams or scanners can be queried without blocking (or threads of the caller's own). Operations can be waited on,
+iterated over as responses arrive, cancelled, and given a timeout.
 """
 
 import re
+import time
 import shlex
+import Queue
 import logging
+import threading
 import subprocess
 
+import metrics
+
 log = logging.getLogger('reaper.dicom.scu')
 
 RESPONSE_RE = re.compile("""
@@ -24,6 +33,16 @@ W: # Used TransferSyntax: (?P<transfer_syntax>.+)
 (?P<dicom_cvs>(W: \(.+\) .+\n){2,})""")
 DICOM_CV_RE = re.compile(""".*\((?P<idx_0>[0-9a-f]{4}),(?P<idx_1>[0-9a-f]{4})\) (?P<type>\w{2}) (?P<value>.+)#[ ]*(?P<length>\d+),[ ]*(?P<n_elems>\d+) (?P<label>\w+)\n""")
 MOVE_OUTPUT_RE = re.compile('.*Completed Suboperations +: ([a-zA-Z0-9]+)', re.DOTALL)
+SUBOPERATIONS_RE = re.compile('(Remaining|Completed|Failed|Warning) Suboperations +: (\d+)')
+DATASET_START = 'W: # Dicom-Data-Set'
+
+
+class OperationCancelled(RuntimeError):
+    """Raised by Operation.result() when the operation was cancelled."""
+
+
+class OperationTimeout(OperationCancelled):
+    """Raised by Operation.result() when the operation ran out of time."""
 
 
 class SCU(object):
@@ -42,45 +61,215 @@ class SCU(object):
         self.aet = aet
         self.aec = aec
 
+    @metrics.measured('find', lambda responses: {'responses': len(responses)})
     def find(self, query):
         """ Construct a findscu query. Return a list of Response objects. """
-        cmd = 'findscu -v %s' % self.query_string(query)
-        log.debug(cmd)
-        output = ''
+        return self.find_async(query).result()
+
+    def find_async(self, query, timeout=None):
+        """
+        Start a findscu query in the background. Return a FindOperation, whose result() is the list of Response
+        objects, and which can be iterated over to get each Response as it arrives.
+
+        The query is cancelled if it takes longer than timeout seconds.
+        """
+        return FindOperation('findscu -v %s' % self.query_string(query), query, timeout).start()
+
+    @metrics.measured('move', lambda img_cnt: {'files': img_cnt})
+    def move(self, query, dest_path='.', dest_aet=None):
+        """
+        Construct a movescu query. Return the count of images successfully transferred.
+
+        Images are received by movescu into dest_path, unless dest_aet is given, in which case they are sent to that
+        AE (e.g. a StorageSCP listening on the return port) instead.
+        """
+        return self.move_async(query, dest_path, dest_aet).result()
+
+    def move_async(self, query, dest_path='.', dest_aet=None, on_progress=None, timeout=None):
+        """
+        Start a movescu query in the background, as for move(). Return a MoveOperation, whose result() is the count of
+        images successfully transferred.
+
+        on_progress(completed, remaining) is called as the scanner reports its progress. The move is cancelled if it
+        takes longer than timeout seconds.
+        """
+        if dest_aet:
+            cmd = 'movescu -v --move %s %s' % (dest_aet, self.query_string(query))
+        else:
+            cmd = 'movescu -v -od %s --port %s %s' % (dest_path, self.return_port, self.query_string(query))
+        return MoveOperation(cmd, on_progress, timeout).start()
+
+    def query_string(self, query):
+        """Convert a query into a string to be appended to a findscu or movescu call."""
+        return '-S -aet %s -aec %s %s %s %s' % (self.aet, self.aec, query, self.host, str(self.port))
+
+
+class Operation(object):
+
+    """
+    Operation runs a DCMTK command in the background, reading its output as it is written.
+
+    Use result() to wait for the outcome, which raises subprocess.CalledProcessError if the command failed, and
+    OperationCancelled (or OperationTimeout) if cancel() was called (or timeout seconds went by) first. Subclasses
+    handle each line of output in _line(), and compute the outcome in _result().
+    """
+
+    def __init__(self, cmd, timeout=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.output = ''           # all of the output, once the command has finished
+        self.lines = []
+        self.process = None
+        self.cancelled = None       # the exception to raise, once cancelled
+        self.finished = threading.Event()
+
+    def start(self):
+        """Start the command. Returns the operation."""
+        log.debug(self.cmd)
+        self.process = subprocess.Popen(shlex.split(self.cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        bufsize=-1)     # buffered, so readline() doesn't read a byte at a time
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+        if self.timeout is not None:
+            self.timer = threading.Timer(self.timeout, self.cancel, [OperationTimeout(
+                'Timed out after %s seconds: %s' % (self.timeout, self.cmd))])
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def cancel(self, reason=None):
+        """Stop the command, if it is still running."""
+        if self.done():
+            return
+        self.cancelled = reason or OperationCancelled('Cancelled: %s' % self.cmd)
+        try:
+            self.process.terminate()
+        except OSError:
+            pass
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the command to finish. Returns False if it hadn't within timeout seconds."""
+        deadline = timeout is not None and time.time() + timeout
+        while not self.finished.wait(0.1):  # short waits, so that a KeyboardInterrupt gets through
+            if deadline and time.time() > deadline:
+                return False
+        return True
+
+    def result(self, timeout=None):
+        """Wait for the command to finish, and return its outcome."""
         try:
-            output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as ex:
-            log.debug(ex)
-            output and log.debug(output)
-            raise ex
-        if output and re.search('DIMSE Status .* Success', output):
-            return [Response(query.kwargs.keys(), match_obj.groupdict()) for match_obj in RESPONSE_RE.finditer(output)]
+            finished = self.wait(timeout)
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        if not finished:
+            raise OperationTimeout('Still running after %s seconds: %s' % (timeout, self.cmd))
+        if self.cancelled:
+            raise self.cancelled
+        if self.process.returncode:
+            log.debug('Command %s returned %s' % (self.cmd, self.process.returncode))
+            self.output and log.debug(self.output)
+            raise subprocess.CalledProcessError(self.process.returncode, self.cmd, self.output)
+        return self._result()
+
+    def _read(self):
+        try:
+            for line in iter(self.process.stdout.readline, ''):
+                self.lines.append(line)
+                self._line(line)
+            self.process.wait()
+            self._line(None)
+        finally:
+            self.output = ''.join(self.lines)
+            if self.timeout is not None:
+                self.timer.cancel()
+            self.finished.set()
+
+    def _line(self, line):
+        """Handle a line of output, or the end of the output (None)."""
+
+    def _result(self):
+        return self.output
+
+
+class FindOperation(Operation):
+
+    """FindOperation is a findscu query running in the background (see SCU.find_async)."""
+
+    def __init__(self, cmd, query, timeout=None):
+        super(FindOperation, self).__init__(cmd, timeout)
+        self.query = query
+        self.dataset = None         # lines of the response being read
+        self.parsed = []            # every Response read
+        self.responses = Queue.Queue()
+
+    def __iter__(self):
+        """Yield each Response as it arrives. Raises as result() does if the query fails."""
+        while True:
+            response = self.responses.get()
+            if response is None:
+                break
+            yield response
+        self.result()
+
+    def _line(self, line):
+        if self.dataset is not None and (line is None or not line.startswith('W: ')
+                                         or line.startswith(DATASET_START)):
+            match_obj = RESPONSE_RE.search('\n' + ''.join(self.dataset))
+            if match_obj:
+                response = Response(self.query.kwargs.keys(), match_obj.groupdict())
+                self.parsed.append(response)
+                self.responses.put(response)
+            self.dataset = None
+        if line is None:
+            self.responses.put(None)
+        elif line.startswith(DATASET_START):
+            self.dataset = [line]
+        elif self.dataset is not None:
+            self.dataset.append(line)
+
+    def _result(self):
+        if self.output and re.search('DIMSE Status .* Success', self.output):
+            return list(self.parsed)
         else:
-            log.warning(cmd)
-            log.warning(output)
+            log.warning(self.cmd)
+            log.warning(self.output)
             return []
 
-    def move(self, query, dest_path='.'):
-        """Construct a movescu query. Return the count of images successfully transferred."""
-        cmd = 'movescu -v -od %s --port %s %s' % (dest_path, self.return_port, self.query_string(query))
-        log.debug(cmd)
-        output = ''
-        try:
-            output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as ex:
-            log.debug(ex)
-            output and log.debug(output)
-            raise ex
+
+class MoveOperation(Operation):
+
+    """MoveOperation is a movescu query running in the background (see SCU.move_async)."""
+
+    def __init__(self, cmd, on_progress=None, timeout=None):
+        super(MoveOperation, self).__init__(cmd, timeout)
+        self.on_progress = on_progress
+        self.suboperations = {}
+
+    def _line(self, line):
+        match_obj = line and SUBOPERATIONS_RE.search(line)
+        if not match_obj:
+            return
+        kind, count = match_obj.group(1), int(match_obj.group(2))
+        changed = self.suboperations.get(kind) != count
+        self.suboperations[kind] = count
+        if kind == 'Completed' and changed and self.on_progress:
+            try:
+                self.on_progress(self.suboperations['Completed'], self.suboperations.get('Remaining', 0))
+            except Exception as ex:
+                log.warning('Progress callback failed: %s' % ex)
+
+    def _result(self):
         try:
-            img_cnt = int(MOVE_OUTPUT_RE.match(output).group(1))
+            img_cnt = int(MOVE_OUTPUT_RE.match(self.output).group(1))
         except (ValueError, AttributeError):
             img_cnt = 0
         return img_cnt
 
-    def query_string(self, query):
-        """Convert a query into a string to be appended to a findscu or movescu call."""
-        return '-S -aet %s -aec %s %s %s %s' % (self.aet, self.aec, query, self.host, str(self.port))
-
 
 class Query(object):
 
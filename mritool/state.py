@@ -0,0 +1,339 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Keeps track of which exams sync has pulled, in an SQLite database.
+
+Each exam has a status (queued, pulling, done or failed), timestamps, and the
+number of images and bytes pulled. An exam is claimed before it is pulled, in a
+transaction, so two syncs never pull the same exam, and an exam whose pull was
+interrupted (its owner is gone) can be claimed again and resumed.
+
+The database can be shared by syncs on several hosts (on a shared volume with
+working file locks). A claim is a lease that lasts LEASE seconds, and is renewed
+by a heartbeat (see StateStore.heartbeat) while the exam is pulled, so the
+exams of a worker that crashed, or lost its host, can be claimed by others once
+its leases expire. Times are kept in UTC, so hosts in other timezones (or a
+change to daylight saving time) don't cut leases short, but the hosts' clocks
+must agree to well within a lease.
+"""
+import os
+import errno
+import socket
+import sqlite3
+import datetime
+import _strptime    # strptime() on threads fails unless this is imported first
+import threading
+
+QUEUED  = 'queued'
+PULLING = 'pulling'
+DONE    = 'done'
+FAILED  = 'failed'
+
+LEASE   = 300       # seconds a claim lasts without being renewed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exams (
+    examid   TEXT PRIMARY KEY,
+    status   TEXT NOT NULL,
+    queued   TEXT,
+    started  TEXT,
+    finished TEXT,
+    images   INTEGER NOT NULL DEFAULT 0,
+    bytes    INTEGER NOT NULL DEFAULT 0,
+    owner    TEXT,
+    lease    TEXT,
+    message  TEXT
+);
+CREATE INDEX IF NOT EXISTS exams_status ON exams (status);
+CREATE TABLE IF NOT EXISTS processing (
+    examid    TEXT NOT NULL,
+    processor TEXT NOT NULL,
+    series    TEXT NOT NULL,
+    status    TEXT NOT NULL,
+    updated   TEXT,
+    message   TEXT,
+    PRIMARY KEY (examid, processor, series)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key      TEXT PRIMARY KEY,
+    value    TEXT
+);
+"""
+
+def now():
+    """ Returns the time now, in UTC. """
+    return datetime.datetime.utcnow().isoformat()
+
+def later(seconds):
+    """ Returns the time <seconds> from now, as written by now(). """
+    return (datetime.datetime.utcnow() + datetime.timedelta(seconds = seconds)).isoformat()
+
+def parse_time(text):
+    """ Parses a timestamp written by now(). """
+    for format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(text, format)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def owner_id():
+    """ Identifies this process as <host>:<pid>. """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+def owner_alive(owner):
+    """
+    Returns False if <owner> is a process on this host that no longer exists.
+
+    Owners on other hosts can't be checked, and are assumed to be alive.
+    """
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+    return True
+
+def leased(record):
+    """
+    Returns True if the owner of an exam record still holds it: its lease
+    hasn't expired, and it isn't a process on this host that has exited.
+    """
+    expires = parse_time(record["lease"])
+    if expires and expires < datetime.datetime.utcnow():
+        return False
+    return owner_alive(record["owner"])
+
+class StateStore(object):
+    """
+    The sync state of every exam, stored in the database at <path>.
+
+    Exams claimed by this store are leased for <lease> seconds at a time. A
+    <readonly> store only queries the database (which must exist), and leaves
+    its schema as it is.
+    """
+
+    def __init__(self, path, timeout = 60, lease = LEASE, readonly = False):
+        self.path  = path
+        self.owner = owner_id()
+        self.lease = lease
+        self.db    = sqlite3.connect(path, timeout = timeout,
+                isolation_level = None, check_same_thread = False)
+        self.db.row_factory = sqlite3.Row
+        self.lock  = threading.RLock()    # the connection is shared by threads
+        if readonly:
+            self.db.execute("PRAGMA query_only = ON")
+            return
+        self.db.executescript(SCHEMA)
+        with self.transaction() as db:    # databases from before leases
+            columns = [row[1] for row in db.execute("PRAGMA table_info(exams)")]
+            if "lease" not in columns:
+                db.execute("ALTER TABLE exams ADD COLUMN lease TEXT")
+
+    def transaction(self):
+        """ Returns a context manager for a write transaction. """
+        return _Transaction(self.db, self.lock)
+
+    def query(self, sql, *params):
+        """ Returns all the rows of a read-only query. """
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def import_exams_txt(self, path):
+        """
+        Marks the exams listed in an exams.txt file (from older versions of
+        sync) as done. Only happens once per store.
+
+        Returns the number of exams imported.
+        """
+        with self.transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'exams_txt'").fetchone():
+                return 0
+            examids = []
+            if os.path.exists(path):
+                examids = set(line.strip() for line in open(path) if line.strip())
+            db.executemany("INSERT OR IGNORE INTO exams (examid, status, finished) "
+                           "VALUES (?, ?, ?)", [(e, DONE, now()) for e in examids])
+            db.execute("INSERT INTO meta (key, value) VALUES ('exams_txt', ?)",
+                       (path,))
+            return len(examids)
+
+    def get(self, examid):
+        """ Returns the record for an exam, or None. """
+        rows = self.query("SELECT * FROM exams WHERE examid = ?", examid)
+        return rows and rows[0] or None
+
+    def status(self, examid):
+        """ Returns the status of an exam, or None if it isn't known. """
+        record = self.get(examid)
+        return record and record["status"]
+
+    def with_status(self, status):
+        """ Returns the set of exam ids with the given status. """
+        return set(row[0] for row in self.query(
+            "SELECT examid FROM exams WHERE status = ?", status))
+
+    def throughput(self, recent = 20):
+        """
+        Returns the images per second of the <recent> latest pulls, or None if
+        nothing has been pulled yet.
+        """
+        images, seconds = 0, 0
+        for row in self.query("SELECT images, started, finished FROM exams "
+                "WHERE status = ? AND images > 0 AND started IS NOT NULL "
+                "ORDER BY finished DESC LIMIT ?", DONE, recent):
+            started, finished = parse_time(row["started"]), parse_time(row["finished"])
+            if not (started and finished): continue
+            images  += row["images"]
+            seconds += (finished - started).total_seconds()
+        return seconds and images / seconds or None
+
+    def bytes_per_image(self, recent = 50):
+        """
+        Returns the average bytes per image of the <recent> latest pulls, or None
+        if nothing has been pulled yet.
+        """
+        images, size = self.query("SELECT SUM(images), SUM(bytes) FROM "
+                "(SELECT images, bytes FROM exams WHERE status = ? AND images > 0 "
+                "AND bytes > 0 ORDER BY finished DESC LIMIT ?)", DONE, recent)[0]
+        return images and size // images or None
+
+    def queue(self, examids):
+        """ Records that exams are waiting to be pulled. """
+        with self.transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO exams (examid, status, queued) "
+                           "VALUES (?, ?, ?)", [(e, QUEUED, now()) for e in examids])
+
+    def claim(self, examid):
+        """
+        Marks an exam as being pulled by this process, for the next <lease>
+        seconds (see renew).
+
+        Returns False if the exam is done, or being pulled by someone else whose
+        lease hasn't expired.
+        """
+        with self.transaction() as db:
+            record = db.execute("SELECT * FROM exams WHERE examid = ?",
+                    (examid,)).fetchone()
+            if record and record["status"] == DONE:
+                return False
+            if record and record["status"] == PULLING and \
+               record["owner"] != self.owner and leased(record):
+                return False
+            db.execute("INSERT OR IGNORE INTO exams (examid, status, queued) "
+                       "VALUES (?, ?, ?)", (examid, QUEUED, now()))
+            db.execute("UPDATE exams SET status = ?, started = ?, owner = ?, "
+                       "lease = ?, message = NULL WHERE examid = ?",
+                       (PULLING, now(), self.owner, later(self.lease), examid))
+            return True
+
+    def renew(self, examid):
+        """
+        Extends this process's lease on an exam it is pulling.
+
+        Returns False if the exam is no longer claimed by this process.
+        """
+        with self.transaction() as db:
+            return db.execute("UPDATE exams SET lease = ? WHERE examid = ? AND "
+                    "status = ? AND owner = ?", (later(self.lease), examid,
+                    PULLING, self.owner)).rowcount == 1
+
+    def heartbeat(self, examid):
+        """
+        Returns a context manager that renews the lease on <examid> every third
+        of a lease until the block ends.
+        """
+        return _Heartbeat(self, examid, self.lease / 3.0)
+
+    def finish(self, examid, images = 0, bytes = 0):
+        """
+        Records that an exam was pulled. Returns False if the exam is no longer
+        claimed by this process (see _end).
+        """
+        return self._end(examid, DONE, images = images, bytes = bytes)
+
+    def fail(self, examid, message = None):
+        """
+        Records that pulling an exam failed. Returns False if the exam is no
+        longer claimed by this process (see _end).
+        """
+        return self._end(examid, FAILED, message = message)
+
+    def record_processing(self, examid, processor, series, status,
+            message = None):
+        """ Records the status of a processor's run on a series of an exam. """
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO processing (examid, processor, "
+                       "series, status, updated, message) VALUES "
+                       "(?, ?, ?, ?, ?, ?)",
+                       (examid, processor, series, status, now(), message))
+
+    def processing(self, examid):
+        """ Returns the processing records of an exam. """
+        return self.query("SELECT * FROM processing WHERE examid = ? "
+                          "ORDER BY series, processor", examid)
+
+    def _end(self, examid, status, images = 0, bytes = 0, message = None):
+        """
+        Ends this process's claim on an exam. Nothing is recorded if the claim
+        was taken over by someone else (after our lease expired), since they
+        are pulling the exam now.
+        """
+        with self.transaction() as db:
+            return db.execute("UPDATE exams SET status = ?, finished = ?, "
+                       "images = ?, bytes = ?, owner = NULL, lease = NULL, "
+                       "message = ? WHERE examid = ? AND owner = ?",
+                       (status, now(), images, bytes, message, examid,
+                        self.owner)).rowcount == 1
+
+class _Transaction(object):
+    """ Holds the database's write lock from the start of the block. """
+
+    def __init__(self, db, lock):
+        self.db   = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+        except:
+            self.lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.db.execute(exc_type and "ROLLBACK" or "COMMIT")
+        finally:
+            self.lock.release()
+
+class _Heartbeat(object):
+    """
+    Renews a lease from a thread of its own. lost is set if the lease was
+    taken over by someone else.
+    """
+
+    def __init__(self, store, examid, interval):
+        self.store    = store
+        self.examid   = examid
+        self.interval = interval
+        self.stopped  = threading.Event()
+        self.lost     = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.store.renew(self.examid):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,230 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Times mritool operations against a synthetic scanner.
+
+Usage:
+    benchmark.py [options]
+    benchmark.py compare <before> <after>
+
+Options:
+    --scales=<list>           Images per exam to time [default: 1,10,100,1000,10000]
+    --series=<num>            Series per exam [default: 10]
+    --exams=<num>             Other exams on the scanner [default: 50]
+    --pfiles=<num>            Pfiles (of other exams) in the pfile dir [default: 20]
+    --pixels=<bytes>          Bytes of pixel data per image [default: 32768]
+    --codec=<codec>           Compression for pull-compressed [default: jpeg-ls]
+    --only=<list>             Only time these operations (comma separated)
+    --results-dir=<dir>       Where results are saved [default: bench-results]
+
+Results are saved as <results-dir>/<commit>.json, and can be compared with
+`benchmark.py compare <before.json> <after.json>`. Along with the timings, the
+bytes stored by pull and pull-compressed (which asks for a compressed transfer
+syntax and stores the images with --codec) are saved and shown.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import datetime
+import subprocess
+from docopt import docopt
+import tabulate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from mritool import command_line, scu
+import synthetic
+
+AET = "mrsrv1"
+OPERATIONS = ["pull", "pull-compressed", "sort_exam", "find_pfiles", "check", "check-deep",
+              "complete",
+              "list-exams", "startup-import", "startup-help",
+              "startup-list-exams"]
+
+# Runs the mritool command line in a fresh interpreter, to time start up
+STARTUP = ("import sys; sys.path.insert(0, {root!r}); "
+           "from mritool import command_line; "
+           "sys.argv = ['mritool'] + sys.argv[1:]; command_line.main()")
+
+def timed(results, operation, scale, func, *args, **kwargs):
+    start = time.time()
+    value = func(*args, **kwargs)
+    results.setdefault(operation, {})[str(scale)] = time.time() - start
+    return value
+
+def run_mritool(*args):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call([sys.executable, "-c",
+            STARTUP.format(root=root)] + list(args), stdout=devnull,
+            stderr=devnull)
+
+def pull_compressed(connection, study, output_dir, pfile_dir, query, codec):
+    receiver = command_line.Receiver(connection, output_dir,
+            transfer_syntax = codec, codec = codec)
+    with receiver:
+        return command_line._pull_exam(connection, study, output_dir,
+                pfile_dir, query, receiver = receiver)
+
+def run_scale(scale, options, only, sizes):
+    """
+    Times each operation on an exam of <scale> images. Returns timings, and
+    adds the bytes stored by pulls to <sizes>.
+    """
+    results = {}
+    root    = tempfile.mkdtemp(prefix="mritool-bench-")
+    archive = os.path.join(root, "scanner")
+    port    = synthetic.free_port()
+    arguments = synthetic.arguments_for(root, port, AET)
+    for key in ['--inprocess-dir', '--processed-dir', '--log-dir', '--pfile-dir']:
+        os.makedirs(arguments[key])
+    synthetic.use_standins(archive, AET, port)
+
+    try:
+        examid = "1000"
+        study  = synthetic.make_exam(archive, examid, images = scale,
+                series = int(options['--series']),
+                pixels = int(options['--pixels']))
+        for i in range(int(options['--exams'])):
+            synthetic.make_exam(archive, 2000 + i)
+
+        seriescount = min(scale, int(options['--series']))
+        for n in range(1, seriescount + 1):
+            synthetic.make_pfile(os.path.join(arguments['--pfile-dir'],
+                "P{:05d}.7".format(n)), examid, n)
+        for n in range(int(options['--pfiles'])):
+            synthetic.make_pfile(os.path.join(arguments['--pfile-dir'],
+                "P{:05d}.7".format(1000 + n)), 2000 + n, 1)
+
+        connection = command_line._get_scanner_connection(arguments)
+        inprocess  = arguments['--inprocess-dir']
+        examdir    = os.path.join(inprocess, command_line.format_exam_name(study))
+
+        if "pull" in only:
+            counts = timed(results, "pull", scale, command_line._pull_exam,
+                    connection, study, inprocess, arguments['--pfile-dir'],
+                    scu.StudyQuery(StudyID = examid))
+            sizes.setdefault("pull", {})[str(scale)] = counts and counts["bytes"]
+
+        if "pull-compressed" in only:
+            compressed = os.path.join(root, "compressed")
+            os.makedirs(compressed)
+            counts = timed(results, "pull-compressed", scale, pull_compressed,
+                    connection, study, compressed, arguments['--pfile-dir'],
+                    scu.StudyQuery(StudyID = examid), options['--codec'])
+            sizes.setdefault("pull-compressed", {})[str(scale)] = \
+                    counts and counts["bytes"]
+
+        if "sort_exam" in only:
+            unsorted = os.path.join(root, "unsorted")
+            os.makedirs(unsorted)
+            studydir = os.path.join(archive, examid)
+            for series in os.listdir(studydir):
+                seriesdir = os.path.join(studydir, series)
+                if not os.path.isdir(seriesdir): continue
+                for f in os.listdir(seriesdir):
+                    if f.endswith(".dcm"):
+                        shutil.copy(os.path.join(seriesdir, f), unsorted)
+            timed(results, "sort_exam", scale, command_line.sort_exam,
+                    unsorted, os.path.join(root, "sorted"))
+
+        if "find_pfiles" in only and os.path.exists(examdir):
+            timed(results, "find_pfiles", scale, command_line.find_pfiles,
+                    arguments['--pfile-dir'], examdir, examid)
+
+        if "check" in only and os.path.exists(examdir):
+            timed(results, "check", scale, command_line._check_inprocess,
+                    examid, examdir, connection)
+
+        if "check-deep" in only and os.path.exists(examdir):
+            timed(results, "check-deep", scale, command_line._check_inprocess,
+                    examid, examdir, connection, True)
+
+        if "complete" in only and os.path.exists(examdir):
+            timed(results, "complete", scale, command_line.package_exams,
+                    dict(arguments, **{'<exam>' : examid}))
+
+        if "list-exams" in only:
+            timed(results, "list-exams", scale, command_line.list_exams,
+                    arguments)
+
+        if "startup-import" in only:
+            timed(results, "startup-import", scale, subprocess.check_call,
+                    [sys.executable, "-c", "import mritool.command_line"],
+                    cwd = os.path.join(os.path.dirname(__file__), ".."))
+        if "startup-help" in only:
+            timed(results, "startup-help", scale, run_mritool, "help")
+        if "startup-list-exams" in only:
+            timed(results, "startup-list-exams", scale, run_mritool,
+                    "--host=127.0.0.1", "--port={}".format(port),
+                    "--aet={}".format(AET), "list-exams")
+    finally:
+        subprocess.call(["chmod", "-R", "u+w", root])
+        shutil.rmtree(root)
+    return results
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def show(results, format="{:.3f}"):
+    scales  = sorted(set(s for op in results.values() for s in op), key=int)
+    headers = ["Operation"] + ["{} images".format(s) for s in scales]
+    table   = [[op] + [format.format(results[op][s]) if s in results[op] else ""
+                       for s in scales]
+               for op in OPERATIONS if op in results]
+    print tabulate.tabulate(table, headers=headers)
+
+def compare(before, after):
+    """Prints the speedup of each timing in <after> over <before>."""
+    before  = json.load(open(before))
+    after   = json.load(open(after))
+    ratios  = {}
+    for op, timings in after["results"].items():
+        for scale, seconds in timings.items():
+            previous = before["results"].get(op, {}).get(scale)
+            if previous and seconds:
+                ratios.setdefault(op, {})[scale] = previous / seconds
+    print "Speedup of {} over {} (>1 is faster)".format(
+            after["commit"], before["commit"])
+    show(ratios)
+
+def main():
+    options = docopt(__doc__)
+    if options['compare']:
+        compare(options['<before>'], options['<after>'])
+        return
+
+    command_line.logger.setLevel(logging.WARNING)
+    only    = (options['--only'] or ",".join(OPERATIONS)).split(",")
+    results = {}
+    sizes   = {}
+    for scale in [int(s) for s in options['--scales'].split(",")]:
+        for op, timings in run_scale(scale, options, only, sizes).items():
+            results.setdefault(op, {}).update(timings)
+
+    show(results)
+    if sizes:
+        print
+        print "Bytes stored"
+        show(sizes, "{}")
+
+    record = { "commit"  : commit(),
+               "date"    : datetime.datetime.now().isoformat(),
+               "options" : options,
+               "results" : results,
+               "sizes"   : sizes }
+    if not os.path.exists(options['--results-dir']):
+        os.makedirs(options['--results-dir'])
+    path = os.path.join(options['--results-dir'], record["commit"] + ".json")
+    json.dump(record, open(path, "w"), indent=2, sort_keys=True)
+    print
+    print "Saved results to {}".format(path)
+
+if __name__ == "__main__":
+    main()
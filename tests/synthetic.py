@@ -0,0 +1,191 @@
+# vim: expandtab ts=4 sw=4 tw=80:
+"""
+Generators for synthetic scanner data, used by the tests and benchmarks.
+
+Exams are laid out as a scanner archive that the stand-ins in tests/standins
+can serve:
+
+    <archive>/<StudyID>/study.json                  study-level attributes
+    <archive>/<StudyID>/<SeriesNumber>/series.json  series-level attributes
+    <archive>/<StudyID>/<SeriesNumber>/images.json  image-level attributes
+    <archive>/<StudyID>/<SeriesNumber>/*.dcm        images
+"""
+import ctypes
+import json
+import os
+import random
+import socket
+import struct
+import dicom
+import dicom.dataset
+import pfile_tools.headers
+
+STANDINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "standins")
+
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1"
+
+_pixel_data = {}
+def pixel_data(size):
+    """
+    Returns <size> bytes of 12 bit pixels that wander from one to the next, so
+    that they compress losslessly a little like MR images do.
+    """
+    if size not in _pixel_data:
+        rng, value, pixels = random.Random(size), 2048, []
+        for i in range(size // 2):
+            value = min(4095, max(0, value + rng.randint(-16, 16)))
+            pixels.append(value)
+        _pixel_data[size] = struct.pack("<{}H".format(len(pixels)), *pixels) + \
+                "\0" * (size % 2)
+    return _pixel_data[size]
+
+def write_dicom(path, studyid, seriesno, descr, instance, pixels = 0, **headers):
+    """
+    Writes a minimal MR image.
+
+    <pixels> is the number of bytes of pixel data to include (see pixel_data).
+    Extra <headers> are set on the dataset as given.
+    """
+    meta = dicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID    = MR_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = "1.2.3.{}.{}.{}".format(
+            studyid, seriesno, instance)
+    meta.TransferSyntaxUID          = EXPLICIT_VR_LITTLE_ENDIAN
+    meta.ImplementationClassUID     = "1.2.3.4"
+
+    ds = dicom.dataset.FileDataset(path, {}, file_meta=meta, preamble="\0"*128)
+    ds.is_little_endian  = True
+    ds.is_implicit_VR    = False
+    ds.SOPClassUID       = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID    = meta.MediaStorageSOPInstanceUID
+    ds.StudyID           = str(studyid)
+    ds.SeriesNumber      = seriesno
+    ds.SeriesDescription = descr
+    ds.InstanceNumber    = instance
+    for key, value in headers.items():
+        setattr(ds, key, value)
+    if pixels:
+        ds.add_new(0x7fe00010, 'OW', pixel_data(pixels))
+    ds.save_as(path)
+
+def make_exam(archive, studyid, series = 1, images = 1, pixels = 0,
+        description = "SPN01", date = "20160615", patientid = None):
+    """
+    Writes an exam with <images> spread evenly across <series> series.
+
+    Returns the study-level attributes of the exam.
+    """
+    studyid  = str(studyid)
+    studydir = os.path.join(archive, studyid)
+    study    = { "StudyID"          : studyid,
+                 "StudyDate"        : date,
+                 "StudyDescription" : description,
+                 "PatientID"        : patientid or "P{}".format(studyid),
+                 "PatientName"      : "SYNTHETIC^{}".format(studyid) }
+    os.makedirs(studydir)
+    json.dump(study, open(os.path.join(studydir, "study.json"), "w"))
+
+    series = max(1, min(series, images))
+    for s in range(series):
+        seriesno = s + 1
+        count    = images // series + (1 if s < images % series else 0)
+        descr    = "Synthetic Series {}".format(seriesno)
+        seriesdir = os.path.join(studydir, str(seriesno))
+        os.makedirs(seriesdir)
+        json.dump({ "SeriesNumber"        : str(seriesno),
+                    "SeriesDescription"   : descr,
+                    "ImagesInAcquisition" : str(count) },
+                  open(os.path.join(seriesdir, "series.json"), "w"))
+        images_info = []
+        for i in range(1, count + 1):
+            name = "{}.{}.{}.dcm".format(studyid, seriesno, i)
+            write_dicom(os.path.join(seriesdir, name), studyid, seriesno,
+                    descr, i, pixels = pixels, StudyDate = date,
+                    StudyDescription = description,
+                    PatientID = study["PatientID"])
+            images_info.append({ "InstanceNumber" : str(i), 
+                "SOPInstanceUID" : "1.2.3.{}.{}.{}".format(studyid, seriesno, i) })
+        json.dump(images_info, open(os.path.join(seriesdir, "images.json"), "w"))
+    return study
+
+def make_pfile(path, exam_number, series_number, revision = "20.007",
+        series_description = "SPIRAL", exam_description = "SPN01",
+        data = 0):
+    """
+    Writes a pfile with the header layout of the given revision.
+
+    <revision> is one of pfile_tools.headers.known_revisions().
+    <data> is the number of bytes of (blank) raw data following the header.
+    """
+    header = pfile_tools.headers.REVISIONS()[revision]()
+    header.revision           = float(revision)
+    header.exam_number        = int(exam_number)
+    header.series_number      = int(series_number)
+    header.series_description = series_description
+    header.exam_description   = exam_description
+    header.exam_type          = "MR"
+    with open(path, "wb") as f:
+        f.write(ctypes.string_at(ctypes.addressof(header),
+                ctypes.sizeof(header)))
+        f.write("\0" * data)
+
+def free_port():
+    """Returns a local port that is free to listen on."""
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def use_standins(archive, aet, port):
+    """
+    Points findscu/movescu/storescp at the stand-ins, serving <archive>.
+
+    Images moved to <aet> are delivered to a storescp listening on <port>.
+    """
+    if STANDINS not in os.environ["PATH"].split(os.pathsep):
+        os.environ["PATH"] = STANDINS + os.pathsep + os.environ["PATH"]
+    os.environ["MRITOOL_STANDIN_ARCHIVE"]      = archive
+    os.environ["MRITOOL_STANDIN_DESTINATIONS"] = "{}=127.0.0.1:{}".format(
+            aet, port)
+
+def arguments_for(root, port, aet, **overrides):
+    """
+    Returns docopt-style arguments for running commands on folders in <root>,
+    against the stand-in scanner.
+    """
+    arguments = {
+        '--inprocess-dir' : os.path.join(root, "inprocess"),
+        '--processed-dir' : os.path.join(root, "processed"),
+        '--log-dir'       : os.path.join(root, "logs"),
+        '--pfile-dir'     : os.path.join(root, "pfiles"),
+        '--host'          : "127.0.0.1",
+        '--port'          : str(port),
+        '--aet'           : aet,
+        '--aec'           : "CAMHMR",
+        '--force'         : True,
+        '--bare'          : False,
+        '--deep'          : False,
+        '--all'           : False,
+        '<exportdir>'     : None,
+        '<exam>'          : None,
+        '<series>'        : None,
+        '-b'              : None,
+        '-d'              : None,
+        '-e'              : None,
+        '-o'              : None,
+        '-j'              : "1",
+        '--order'         : "scanner",
+        '--limits'        : None,
+        '--transfer'      : "uncompressed",
+        '--compress'      : None,
+        '--object-store'  : None,
+        '--return-port'   : None,
+        '--scanners'      : None,
+        '--state-dir'     : None,
+        '--process'       : None,
+        '--process-jobs'  : "2",
+    }
+    arguments.update(overrides)
+    return arguments
@@ -0,0 +1,84 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import command_line, scu
+import synthetic
+import os
+import shutil
+import tempfile
+
+def pulled_exam(root): 
+    archive = os.path.join(root, "scanner")
+    output  = os.path.join(root, "inprocess")
+    os.makedirs(output)
+    synthetic.make_exam(archive, 3806, series = 3, images = 9)
+    port = synthetic.free_port()
+    synthetic.use_standins(archive, "mrsrv1", port)
+    connection = scu.SCU("127.0.0.1", 4006, port, "mrsrv1", "CAMHMR")
+    examinfo   = { "StudyID" : "3806", "StudyDate" : "20160615", 
+                   "StudyDescription" : "SPN01", "PatientID" : "P1" }
+    command_line._pull_exam(connection, examinfo, output, root, 
+            scu.StudyQuery(StudyID = "3806"), bare = True)
+    return connection, os.path.join(output, command_line.format_exam_name(examinfo))
+
+def test_scan_exam_lists_dicoms_per_series(): 
+    root = tempfile.mkdtemp()
+    try: 
+        connection, examdir = pulled_exam(root)
+        open(os.path.join(examdir, "notes.txt"), "w").close()
+        folders = command_line.scan_exam(examdir, jobs = 2)
+        assert sorted(folders) == [ "Ex03806_Se00001_Synthetic-Series-1", 
+                "Ex03806_Se00002_Synthetic-Series-2", 
+                "Ex03806_Se00003_Synthetic-Series-3" ]
+        assert folders["Ex03806_Se00002_Synthetic-Series-2"] == [ 
+                "Ex03806Se00002Im00001.dcm", "Ex03806Se00002Im00002.dcm", 
+                "Ex03806Se00002Im00003.dcm" ]
+        assert command_line._check_inprocess("3806", examdir, connection, 
+                deep = True) == []
+    finally: 
+        shutil.rmtree(root)
+
+def test_deep_check_reports_missing_and_extra_instances(): 
+    root = tempfile.mkdtemp()
+    try: 
+        connection, examdir = pulled_exam(root)
+        seriesdir = os.path.join(examdir, "Ex03806_Se00001_Synthetic-Series-1")
+        os.remove(os.path.join(seriesdir, "Ex03806Se00001Im00002.dcm"))
+        extra = os.path.join(seriesdir, "Ex03806Se00001Im00009.dcm")
+        synthetic.write_dicom(extra, 3806, 1, "Synthetic Series 1", 9)
+
+        seriesinfo = connection.find(scu.SeriesQuery(StudyID = "3806"))
+        report = command_line.check_series_instances(connection, examdir, 
+                "3806", seriesinfo)
+        assert [ (r["series"], r["missing"], r["extra"], r["duplicates"]) 
+                 for r in report ] == [
+                ("1", ["1.2.3.3806.1.2"], [extra], []), 
+                ("2", [], [], []), ("3", [], [], []) ]
+
+        # the count matches, so only the deep check notices
+        assert command_line._check_inprocess("3806", examdir, connection) == []
+        assert len(command_line._check_inprocess("3806", examdir, connection, 
+                deep = True)) == 2
+    finally: 
+        shutil.rmtree(root)
+
+def test_deep_check_reports_duplicates_and_non_dicoms(): 
+    root = tempfile.mkdtemp()
+    try: 
+        connection, examdir = pulled_exam(root)
+        seriesdir = os.path.join(examdir, "Ex03806_Se00002_Synthetic-Series-2")
+        original  = os.path.join(seriesdir, "Ex03806Se00002Im00001.dcm")
+        copy      = os.path.join(seriesdir, "Ex03806Se00002Im00001-copy.dcm")
+        shutil.copy(original, copy)
+        junk = os.path.join(seriesdir, "junk.dcm")
+        with open(junk, "w") as f: 
+            f.write("not a dicom")
+
+        seriesinfo = connection.find(scu.SeriesQuery(StudyID = "3806"))
+        report = command_line.check_series_instances(connection, examdir, 
+                "3806", seriesinfo)
+        assert report[1]["missing"] == []
+        assert report[1]["extra"] == [junk]
+        assert report[1]["duplicates"] == [sorted([original, copy])]
+        assert len(command_line._check_inprocess("3806", examdir, connection, 
+                deep = True)) == 3
+    finally: 
+        shutil.rmtree(root)
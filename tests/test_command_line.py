@@ -0,0 +1,21 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def loaded_modules(*args): 
+    """Runs mritool with <args>, and returns the heavy modules it loaded."""
+    script = ("import sys; from mritool import command_line; "
+              "sys.argv = ['mritool'] + sys.argv[1:]; command_line.main(); "
+              "sys.stderr.write(repr([m for m in ('dicom', 'pfile_tools', "
+              "'tabulate') if m in sys.modules]))")
+    process = subprocess.Popen([sys.executable, "-c", script] + list(args), 
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    assert process.returncode == 0, err
+    return eval(err.strip().splitlines()[-1])
+
+def test_help_does_not_load_heavy_modules(): 
+    assert loaded_modules("help") == []
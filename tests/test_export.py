@@ -0,0 +1,120 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import command_line, export
+from test_pull import setup_batch
+import synthetic
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+
+def read_csv(path): 
+    return list(csv.DictReader(gzip.open(path, "rb")))
+
+def test_export_headers_writes_a_csv_per_exam(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806,3807" }))
+        exportdir = os.path.join(root, "headers")
+        arguments = dict(arguments, **{ '<exportdir>' : exportdir, '-j' : "2" })
+        command_line.export_headers(arguments)
+
+        assert sorted(os.listdir(exportdir)) == [ 
+                "20160601_Ex03806_SPN01_P3806.csv.gz", 
+                "20160615_Ex03807_SPN01_P3807.csv.gz", "manifest.json" ]
+        rows = read_csv(os.path.join(exportdir, "20160601_Ex03806_SPN01_P3806.csv.gz"))
+        assert [ (r["SeriesNumber"], r["InstanceNumber"]) for r in rows ] == [ 
+                ("1", "1"), ("1", "2"), ("2", "1"), ("2", "2") ]
+        assert rows[0]["StudyID"] == "3806"
+        assert rows[0]["SeriesDescription"] == "Synthetic Series 1"
+        assert rows[0]["SOPInstanceUID"] == "1.2.3.3806.1.1"
+        assert os.path.exists(rows[0]["path"])
+    finally: 
+        shutil.rmtree(root)
+
+def test_export_only_reads_changed_exams(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806,3807" }))
+        inprocess = arguments['--inprocess-dir']
+        exams = sorted(os.path.join(inprocess, e) for e in os.listdir(inprocess))
+        exporter = export.Exporter(os.path.join(root, "headers"))
+        assert len(exporter.export(exams)) == 2
+
+        exporter = export.Exporter(os.path.join(root, "headers"))
+        assert exporter.export(exams) == []
+
+        seriesdir = os.path.join(exams[1], "Ex03807_Se00001_Synthetic-Series-1")
+        synthetic.write_dicom(os.path.join(seriesdir, "Ex03807Se00001Im00003.dcm"), 
+                3807, 1, "Synthetic Series 1", 3)
+        assert exporter.export(exams) == ["20160615_Ex03807_SPN01_P3807"]
+        assert exporter.manifest["20160615_Ex03807_SPN01_P3807"]["images"] == 3
+        assert len(exporter.export(exams, everything = True)) == 2
+    finally: 
+        shutil.rmtree(root)
+
+def test_manifest_is_saved_in_batches(): 
+    root = tempfile.mkdtemp()
+    every, save_manifest = export.MANIFEST_EVERY, export.Exporter._save_manifest
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806,3807,3808" }))
+        inprocess = arguments['--inprocess-dir']
+        exams = sorted(os.path.join(inprocess, e) for e in os.listdir(inprocess))
+        saves = []
+        export.MANIFEST_EVERY = 2
+        export.Exporter._save_manifest = lambda self: saves.append(len(self.manifest))
+        exporter = export.Exporter(os.path.join(root, "headers"))
+        assert len(exporter.export(exams)) == 3
+        assert saves == [2, 3]
+    finally: 
+        export.MANIFEST_EVERY, export.Exporter._save_manifest = every, save_manifest
+        shutil.rmtree(root)
+
+def test_unchanged_exams_are_not_listed(): 
+    root = tempfile.mkdtemp()
+    exam_files = export.exam_files
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806,3807" }))
+        inprocess = arguments['--inprocess-dir']
+        exams = sorted(os.path.join(inprocess, e) for e in os.listdir(inprocess))
+        exporter = export.Exporter(os.path.join(root, "headers"))
+        exporter.export(exams)
+
+        listed = []
+        def spy(examdir, signature): 
+            listed.append(examdir)
+            return exam_files(examdir, signature)
+        export.exam_files = spy
+        assert exporter.export(exams) == []
+        assert listed == []
+
+        os.mkdir(os.path.join(exams[0], "Ex03806_Se00003_New"))
+        assert exporter.export(exams) == ["20160601_Ex03806_SPN01_P3806"]
+        assert listed == [exams[0]]
+    finally: 
+        export.exam_files = exam_files
+        shutil.rmtree(root)
+
+def test_manifest_drops_exams_that_are_gone(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806,3807" }))
+        inprocess = arguments['--inprocess-dir']
+        exams = sorted(os.path.join(inprocess, e) for e in os.listdir(inprocess))
+        exportdir = os.path.join(root, "headers")
+        export.Exporter(exportdir).export(exams)
+
+        shutil.rmtree(exams[0])
+        synthetic.write_dicom(os.path.join(exams[1], 
+            "Ex03807_Se00001_Synthetic-Series-1", "Ex03807Se00001Im00003.dcm"), 
+            3807, 1, "Synthetic Series 1", 3)
+        export.Exporter(exportdir).export(exams[1:])
+        assert sorted(export.Exporter(exportdir).manifest) == [ 
+                "20160615_Ex03807_SPN01_P3807" ]
+    finally: 
+        shutil.rmtree(root)
@@ -0,0 +1,37 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import metrics
+import json
+import os
+import shutil
+import tempfile
+
+def test_measured_records_phase_per_exam(): 
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, "metrics.jsonl")
+    
+    @metrics.measured("double", lambda result: { "files" : len(result) })
+    def double(items): 
+        return items * 2
+
+    try: 
+        metrics.configure(path)
+        with metrics.exam("3806"): 
+            double([1, 2])
+        double([1])
+        records = [json.loads(line) for line in open(path)]
+        assert [r["exam"] for r in records] == ["3806", None]
+        assert [r["files"] for r in records] == [4, 2]
+        assert all(r["phase"] == "double" for r in records)
+    finally: 
+        metrics.configure(None)
+        shutil.rmtree(root)
+
+def test_measured_summarizes_only_when_recording(): 
+    summaries = []
+
+    @metrics.measured("double", lambda result: summaries.append(result) or {})
+    def double(items): 
+        return items * 2
+
+    assert double([1]) == [1, 1]
+    assert summaries == []
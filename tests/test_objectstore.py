@@ -0,0 +1,87 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import command_line, objectstore
+import synthetic
+import os
+import shutil
+import tempfile
+import threading
+
+def test_identical_files_are_stored_once(): 
+    root    = tempfile.mkdtemp()
+    try: 
+        objects = objectstore.ObjectStore(os.path.join(root, "objects"))
+        first, second, other = [ os.path.join(root, name) for name in 
+                ("first", "second", "other") ]
+        open(first, "w").write("pixels" * 100)
+        open(other, "w").write("other")
+
+        assert objects.add(first) == objectstore.digest(first)
+        assert not objects.place(other, os.path.join(root, "other-copy"))
+        assert objects.place(first, second)
+        assert os.path.samefile(first, second)
+        assert open(second).read() == "pixels" * 100
+
+        usage = objects.usage()
+        assert usage["objects"] == 2 and usage["links"] == 3
+        assert usage["saved"] == 600
+
+        os.remove(other)
+        os.remove(os.path.join(root, "other-copy"))
+        assert objects.gc() == (1, 5)
+        assert objects.usage()["objects"] == 1
+    finally: 
+        shutil.rmtree(root)
+
+def test_gc_waits_for_objects_being_placed(): 
+    root = tempfile.mkdtemp()
+    try: 
+        objects = objectstore.ObjectStore(os.path.join(root, "objects"))
+        other   = objectstore.ObjectStore(os.path.join(root, "objects"))
+        source, first, second = [ os.path.join(root, name) for name in 
+                ("source", "first", "second") ]
+        open(source, "w").write("pixels")
+        objects.place(source, first)
+        os.remove(first)        # the object is garbage, until placed again
+
+        # gc, as if from another process, runs as the object is linked
+        collected = []
+        gc = threading.Thread(target = lambda: collected.append(other.gc()))
+        link = objects._link
+        def link_during_gc(obj, dest): 
+            gc.start()
+            gc.join(0.5)
+            link(obj, dest)
+        objects._link = link_during_gc
+        assert objects.place(source, second)
+        gc.join()
+
+        assert collected == [(0, 0)]
+        assert open(second).read() == "pixels"
+    finally: 
+        shutil.rmtree(root)
+
+def test_repull_costs_only_links(): 
+    root = tempfile.mkdtemp()
+    try: 
+        archive   = os.path.join(root, "scanner")
+        synthetic.make_exam(archive, 3806, series = 2, images = 4, pixels = 1024)
+        port      = synthetic.free_port()
+        synthetic.use_standins(archive, "mrsrv1", port)
+        arguments = synthetic.arguments_for(root, port, "mrsrv1", **{ 
+            '<exam>' : "3806", '--bare' : True, 
+            '--object-store' : os.path.join(root, "objects") })
+        os.makedirs(arguments['--inprocess-dir'])
+        command_line.pull_exams(arguments)
+
+        again = os.path.join(root, "again")
+        os.makedirs(again)
+        command_line.pull_exams(dict(arguments, **{ '-o' : again }))
+
+        series = os.path.join("20160615_Ex03806_SPN01_P3806", 
+                "Ex03806_Se00001_Synthetic-Series-1", "Ex03806Se00001Im00001.dcm")
+        assert os.path.samefile(os.path.join(arguments['--inprocess-dir'], series), 
+                                os.path.join(again, series))
+        usage = objectstore.ObjectStore(arguments['--object-store']).usage()
+        assert usage["objects"] == 4 and usage["links"] == 8
+    finally: 
+        shutil.rmtree(root)
@@ -1,44 +1,58 @@
 # vim: expandtab ts=4 sw=4 tw=80: 
-from mritools import mritools
-import unittest
+from mritool import pfiles
+import synthetic
+import pfile_tools.headers
+import os
+import shutil
+import tempfile
 
-def test_get_pfile_info_nonexistant(): 
+def test_get_pfile_headers_nonexistant(): 
     path = "tests/does-not-exist"
-    pfile = mritools.get_pfile_info(path)
-    assert pfile is None
+    headers = pfiles.get_pfile_headers(path)
+    assert headers is None
 
-def test_get_pfile_info_invalid_pfile(): 
+def test_get_pfile_headers_invalid_pfile(): 
     path = "tests/test_pfiles.py"
-    pfile = mritools.get_pfile_info(path)
-    assert pfile is None
+    headers = pfiles.get_pfile_headers(path)
+    assert headers is None
 
-def test_get_pfile_info_valid_pfile(): 
+def test_get_pfile_headers_valid_pfile(): 
     path = "tests/valid-pfile.7"
-    pfile = mritools.get_pfile_info(path)
-    assert pfile is not None
-    assert pfile.path == path
-    assert pfile.headers["exam_number"] == 2711
-    assert pfile.headers["exam_description"] == "Daily QA" 
-    assert pfile.headers["exam_type"] == "MR" 
-    assert pfile.headers["series_number"] == 6
-    assert pfile.headers["series_description"] == "AX FSPGR"
+    headers = pfiles.get_pfile_headers(path)
+    assert headers is not None
+    assert headers["exam_number"] == 2711
+    assert headers["exam_description"] == "Daily QA" 
+    assert headers["exam_type"] == "MR" 
+    assert headers["series_number"] == 6
+    assert headers["series_description"] == "AX FSPGR"
 
-def test_get_pfile_info_valid_hos_pfile(): 
+def test_get_pfile_headers_valid_hos_pfile(): 
     path = "tests/valid-hos-pfile.7"
-    pfile = mritools.get_pfile_info(path)
-    assert pfile is not None
-    assert pfile.path == path
-    assert pfile.headers["exam_number"] == 2713
-    assert pfile.headers["exam_description"] == "ALCO1MR" 
-    assert pfile.headers["exam_type"] == "MR" 
-    assert pfile.headers["series_number"] == 4
-    assert pfile.headers["series_description"] == "HOS"
+    headers = pfiles.get_pfile_headers(path)
+    assert headers is not None
+    assert headers["exam_number"] == 2713
+    assert headers["exam_description"] == "ALCO1MR" 
+    assert headers["exam_type"] == "MR" 
+    assert headers["series_number"] == 4
+    assert headers["series_description"] == "HOS"
 
-def tests_get_all_pfiles_info(): 
+def test_get_pfile_headers_synthetic_revisions(): 
+    root = tempfile.mkdtemp()
+    try: 
+        for revision in pfile_tools.headers.known_revisions(): 
+            path = os.path.join(root, "P{}.7".format(revision))
+            synthetic.make_pfile(path, 3806, 7, revision = revision)
+            headers = pfiles.get_pfile_headers(path)
+            assert headers is not None
+            assert headers["exam_number"] == 3806
+            assert headers["series_number"] == 7
+    finally: 
+        shutil.rmtree(root)
+
+def tests_get_all_pfiles_headers(): 
     root = "tests/"
-    pfiles = mritools.get_all_pfiles_info(root)
-    assert len(pfiles) == 2
-    assert "tests/valid-hos-pfile.7" in pfiles
-    assert "tests/valid-pfile.7" in pfiles
-    assert pfiles["tests/valid-pfile.7"].headers["exam_number"] == 2711
-    assert pfiles["tests/valid-pfile.7"].path == "tests/valid-pfile.7"
+    headers = pfiles.get_all_pfiles_headers(root)
+    assert len(headers) == 2
+    assert "tests/valid-hos-pfile.7" in headers
+    assert "tests/valid-pfile.7" in headers
+    assert headers["tests/valid-pfile.7"]["exam_number"] == 2711
@@ -0,0 +1,102 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import command_line, metrics, processing, state
+from test_pull import setup_batch
+import dicom
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+def headers(description, presscsi = False): 
+    ds = dicom.dataset.Dataset()
+    ds.StudyID           = "3806"
+    ds.SeriesNumber      = 1
+    ds.SeriesDescription = description
+    if presscsi: 
+        ds.add_new(processing.PRESSCSI_KEY, 'LO', "presscsi")
+    return ds
+
+def test_plan_chooses_processors_by_series(): 
+    processing.processor("mrs", presscsi = True)(lambda seriesdir, headers: None)
+    try: 
+        jobs = processing.plan(["spiral", "qc", "mrs"], { 
+            "exam/Se1/Im1.dcm" : headers("Resting Spiral"), 
+            "exam/Se2/Im1.dcm" : headers("T1 MPRAGE"), 
+            "exam/Se3/Im1.dcm" : headers("PRESS", presscsi = True) })
+        assert [(name, seriesdir) for name, seriesdir, _ in jobs] == [
+                ("spiral", "exam/Se1"), ("qc", "exam/Se1"), 
+                ("qc", "exam/Se2"), 
+                ("qc", "exam/Se3"), ("mrs", "exam/Se3")]
+    finally: 
+        del processing.PROCESSORS["mrs"]
+
+def test_run_reports_failures(): 
+    root = tempfile.mkdtemp()
+    try: 
+        name, seriesdir, error, message = processing.run("qc", 
+                os.path.join(root, "missing"), {})
+        assert error and error.startswith("OSError")
+    finally: 
+        shutil.rmtree(root)
+
+def test_pull_writes_qc_summaries(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806", 
+            '--process' : "qc" }))
+        examdir = os.path.join(arguments['--inprocess-dir'], 
+                "20160601_Ex03806_SPN01_P3806")
+        for seriesdir in sorted(os.listdir(examdir)): 
+            summary = json.load(open(os.path.join(examdir, seriesdir, "qc.json")))
+            assert summary["images"] == summary["expected"] == 2
+            assert summary["missing"] == []
+    finally: 
+        shutil.rmtree(root)
+
+def test_sync_records_processing(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        os.makedirs(arguments['--log-dir'])
+        command_line.sync(dict(arguments, **{ '-e' : "3807", 
+            '--process' : "qc" }))
+        store = state.StateStore(os.path.join(arguments['--log-dir'], 'exams.db'))
+        records = store.processing("3807")
+        assert [(r["processor"], r["series"], r["status"]) for r in records] == [
+                ("qc", "Ex03807_Se00001_Synthetic-Series-1", state.DONE)]
+    finally: 
+        metrics.configure(None)
+        shutil.rmtree(root)
+
+def test_pull_forks_processing_first_and_stops_it_on_failure(): 
+    root = tempfile.mkdtemp()
+    ProcessingPool, exam_sizes = processing.ProcessingPool, command_line._exam_sizes
+    pools = []
+    class Pool(ProcessingPool): 
+        def __init__(self, *args): 
+            self.threads = threading.active_count()
+            self.stopped = False
+            ProcessingPool.__init__(self, *args)
+            pools.append(self)
+        def terminate(self): 
+            self.stopped = True
+            ProcessingPool.terminate(self)
+    def fail(*args): 
+        raise KeyboardInterrupt()
+    try: 
+        arguments = setup_batch(root)
+        processing.ProcessingPool, command_line._exam_sizes = Pool, fail
+        threads = threading.active_count()
+        try: 
+            command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806", 
+                '--process' : "qc" }))
+            assert False, "the pull should have been interrupted"
+        except KeyboardInterrupt: 
+            pass
+        assert pools[0].threads == threads
+        assert pools[0].stopped
+    finally: 
+        processing.ProcessingPool, command_line._exam_sizes = ProcessingPool, exam_sizes
+        shutil.rmtree(root)
@@ -0,0 +1,268 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import command_line, metrics, schedule, scu, state
+import synthetic
+import dicom
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+def test_pull_files_images_into_series_folders(): 
+    root    = tempfile.mkdtemp()
+    archive = os.path.join(root, "scanner")
+    output  = os.path.join(root, "inprocess")
+    os.makedirs(output)
+    synthetic.make_exam(archive, 3806, series = 2, images = 5)
+    synthetic.make_exam(archive, 3807, series = 1, images = 1)
+
+    port = synthetic.free_port()
+    synthetic.use_standins(archive, "mrsrv1", port)
+    try: 
+        connection = scu.SCU("127.0.0.1", 4006, port, "mrsrv1", "CAMHMR")
+        examinfo   = { "StudyID" : "3806", "StudyDate" : "20160615", 
+                       "StudyDescription" : "SPN01", "PatientID" : "P1" }
+        command_line._pull_exam(connection, examinfo, output, root, 
+                scu.StudyQuery(StudyID = "3806"), bare = True)
+
+        examdir = os.path.join(output, command_line.format_exam_name(examinfo))
+        assert sorted(os.listdir(output)) == [os.path.basename(examdir)]
+        assert sorted(os.listdir(examdir)) == [
+                "Ex03806_Se00001_Synthetic-Series-1", 
+                "Ex03806_Se00002_Synthetic-Series-2"]
+        assert sorted(os.listdir(os.path.join(examdir, 
+                "Ex03806_Se00002_Synthetic-Series-2"))) == [
+                "Ex03806Se00002Im00001.dcm", "Ex03806Se00002Im00002.dcm"]
+    finally: 
+        shutil.rmtree(root)
+
+def test_pull_doesnt_wait_for_dicoms_that_never_arrive(): 
+    root    = tempfile.mkdtemp()
+    archive = os.path.join(root, "scanner")
+    output  = os.path.join(root, "inprocess")
+    os.makedirs(output)
+    synthetic.make_exam(archive, 3806, series = 1, images = 2)
+    open(os.path.join(archive, "3806", "1", "notadicom.dcm"), "w").close()
+
+    port = synthetic.free_port()
+    synthetic.use_standins(archive, "mrsrv1", port)
+    try: 
+        connection = scu.SCU("127.0.0.1", 4006, port, "mrsrv1", "CAMHMR")
+        examinfo   = { "StudyID" : "3806", "StudyDate" : "20160615", 
+                       "StudyDescription" : "SPN01", "PatientID" : "P1" }
+        start  = time.time()
+        counts = command_line._pull_exam(connection, examinfo, output, root, 
+                scu.StudyQuery(StudyID = "3806"), bare = True)
+        assert counts["files"] == 2
+        assert time.time() - start < 30
+    finally: 
+        shutil.rmtree(root)
+
+def test_pull_copies_pfiles_found_during_transfer(): 
+    root    = tempfile.mkdtemp()
+    archive = os.path.join(root, "scanner")
+    output  = os.path.join(root, "inprocess")
+    pfiles  = os.path.join(root, "pfiles")
+    os.makedirs(output)
+    os.makedirs(pfiles)
+    synthetic.make_exam(archive, 3806, series = 2, images = 4)
+    synthetic.make_pfile(os.path.join(pfiles, "P12345.7"), 3806, 2)
+    synthetic.make_pfile(os.path.join(pfiles, "P23456.7"), 3807, 1)
+
+    port = synthetic.free_port()
+    synthetic.use_standins(archive, "mrsrv1", port)
+    try: 
+        connection = scu.SCU("127.0.0.1", 4006, port, "mrsrv1", "CAMHMR")
+        examinfo   = { "StudyID" : "3806", "StudyDate" : "20160615", 
+                       "StudyDescription" : "SPN01", "PatientID" : "P1" }
+        receiver   = command_line.Receiver(connection, output)
+        with receiver: 
+            counts = command_line._pull_exam(connection, examinfo, output, 
+                    pfiles, scu.StudyQuery(StudyID = "3806"), receiver = receiver)
+        assert counts["files"] == 4
+
+        examdir = os.path.join(output, command_line.format_exam_name(examinfo))
+        assert sorted(os.listdir(os.path.join(examdir, 
+                "Ex03806_Se00002_Synthetic-Series-2"))) == [
+                "Ex03806Se00002Im00001.dcm", "Ex03806Se00002Im00002.dcm", 
+                "Ex03806_Se00002_P12345.7"]
+        assert len(receiver.headers(examdir)) == 2
+    finally: 
+        shutil.rmtree(root)
+
+def setup_batch(root): 
+    archive = os.path.join(root, "scanner")
+    synthetic.make_exam(archive, 3806, series = 2, images = 4, date = "20160601")
+    synthetic.make_exam(archive, 3807, series = 1, images = 2, date = "20160615")
+    synthetic.make_exam(archive, 3808, series = 1, images = 2, date = "20160701")
+    synthetic.make_exam(archive, 60001, series = 1, images = 1, date = "20160615")
+    port = synthetic.free_port()
+    synthetic.use_standins(archive, "mrsrv1", port)
+    arguments = synthetic.arguments_for(root, port, "mrsrv1")
+    for key in ['--inprocess-dir', '--pfile-dir']: 
+        os.makedirs(arguments[key])
+    return arguments
+
+def test_pull_several_exams(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3806,3808", '-j' : "2" }))
+        assert sorted(os.listdir(arguments['--inprocess-dir'])) == [
+                "20160601_Ex03806_SPN01_P3806", "20160701_Ex03808_SPN01_P3808"]
+    finally: 
+        shutil.rmtree(root)
+
+def test_pull_date_range(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        command_line.pull_exams(dict(arguments, **{ '-d' : "20160610-20160710" }))
+        assert sorted(os.listdir(arguments['--inprocess-dir'])) == [
+                "20160615_Ex03807_SPN01_P3807", "20160701_Ex03808_SPN01_P3808"]
+        examdir = os.path.join(arguments['--inprocess-dir'], 
+                "20160701_Ex03808_SPN01_P3808", "Ex03808_Se00001_Synthetic-Series-1")
+        assert len(os.listdir(examdir)) == 2
+    finally: 
+        shutil.rmtree(root)
+
+def test_sync_pulls_in_order(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        os.makedirs(arguments['--log-dir'])
+        command_line.sync(dict(arguments, **{ '--order' : "newest", 
+            '--limits' : "00:00-23:59=2,23:59-00:00=2" }))
+        assert sorted(os.listdir(arguments['--inprocess-dir'])) == [
+                "20160601_Ex03806_SPN01_P3806", "20160615_Ex03807_SPN01_P3807", 
+                "20160701_Ex03808_SPN01_P3808"]
+        store = state.StateStore(os.path.join(arguments['--log-dir'], 'exams.db'))
+        assert store.with_status(state.DONE) == set(["3806", "3807", "3808"])
+        started = [row["examid"] for row in store.query(
+            "SELECT examid FROM exams ORDER BY started")]
+        assert started[0] in ("3808", "3807")
+    finally: 
+        metrics.configure(None)
+        shutil.rmtree(root)
+
+def test_pull_stores_compressed(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        synthetic.make_exam(os.path.join(root, "scanner"), 3809, images = 2, 
+                pixels = 8192)
+        command_line.pull_exams(dict(arguments, **{ '<exam>' : "3809", 
+            '--transfer' : "jpeg-ls", '--compress' : "jpeg-ls" }))
+
+        seriesdir = os.path.join(arguments['--inprocess-dir'], 
+            "20160615_Ex03809_SPN01_P3809", "Ex03809_Se00001_Synthetic-Series-1")
+        images = [ os.path.join(seriesdir, f) for f in sorted(os.listdir(seriesdir)) ]
+        assert len(images) == 2
+        for image in images: 
+            ds = dicom.read_file(image)
+            assert ds.file_meta.TransferSyntaxUID == "1.2.840.10008.1.2.4.80"
+            assert os.path.getsize(image) < 8192
+    finally: 
+        shutil.rmtree(root)
+
+def test_syncs_share_a_state_dir(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_batch(root)
+        state_dir = os.path.join(root, "shared")
+        for host in ["host1", "host2"]: 
+            os.makedirs(os.path.join(root, host))
+        command_line.sync(dict(arguments, **{ '--state-dir' : state_dir, 
+            '--log-dir' : os.path.join(root, "host1"), '-e' : "3806" }))
+        command_line.sync(dict(arguments, **{ '--state-dir' : state_dir, 
+            '--log-dir' : os.path.join(root, "host2") }))
+
+        assert sorted(os.listdir(arguments['--inprocess-dir'])) == [
+                "20160601_Ex03806_SPN01_P3806", "20160615_Ex03807_SPN01_P3807", 
+                "20160701_Ex03808_SPN01_P3808"]
+        store  = state.StateStore(os.path.join(state_dir, 'exams.db'))
+        assert store.with_status(state.DONE) == set(["3806", "3807", "3808"])
+        assert not os.path.exists(os.path.join(root, "host2", "exams.db"))
+    finally: 
+        metrics.configure(None)
+        shutil.rmtree(root)
+
+def test_sync_pulls_only_what_fits(): 
+    root = tempfile.mkdtemp()
+    free_space = command_line._free_space
+    try: 
+        arguments = setup_batch(root)
+        os.makedirs(arguments['--log-dir'])
+        free = command_line.FREE_SPACE_MARGIN + 5 * schedule.IMAGE_BYTES
+        command_line._free_space = lambda folders: [ (folders[0], free) ]
+        command_line.sync(arguments)
+        assert sorted(os.listdir(arguments['--inprocess-dir'])) == [
+                "20160601_Ex03806_SPN01_P3806"]
+        store = state.StateStore(os.path.join(arguments['--log-dir'], 'exams.db'))
+        assert store.with_status(state.QUEUED) == set(["3807", "3808"])
+
+        # past pulls teach sync the real size of images (much smaller)
+        command_line.sync(arguments)
+        assert store.with_status(state.DONE) == set(["3806", "3807", "3808"])
+    finally: 
+        command_line._free_space = free_space
+        metrics.configure(None)
+        shutil.rmtree(root)
+
+def test_pull_refuses_when_out_of_space(): 
+    root = tempfile.mkdtemp()
+    free_space = command_line._free_space
+    try: 
+        arguments = dict(setup_batch(root), **{ '<exam>' : "3806", 
+            '--force' : False })
+        free = command_line.FREE_SPACE_MARGIN // 2
+        command_line._free_space = lambda folders: [ (folders[0], free) ]
+        assert command_line._space_to_pull(arguments['--inprocess-dir']) == (
+                arguments['--inprocess-dir'], 0, free)
+        try: 
+            command_line.pull_exams(arguments)
+            assert False, "expected the pull to be refused"
+        except SystemExit: 
+            pass
+        assert os.listdir(arguments['--inprocess-dir']) == []
+        command_line.pull_exams(dict(arguments, **{ '--force' : True }))
+        assert os.listdir(arguments['--inprocess-dir']) == [
+                "20160601_Ex03806_SPN01_P3806"]
+    finally: 
+        command_line._free_space = free_space
+        shutil.rmtree(root)
+
+def test_pull_reads_past_pulls_without_changing_them(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = dict(setup_batch(root), **{ '<exam>' : "3806" })
+        os.makedirs(arguments['--log-dir'])
+        path = os.path.join(arguments['--log-dir'], 'exams.db')
+        db = sqlite3.connect(path)   # as left by a sync from before leases
+        db.execute("CREATE TABLE exams (examid TEXT PRIMARY KEY, status TEXT "
+                "NOT NULL, queued TEXT, started TEXT, finished TEXT, images "
+                "INTEGER NOT NULL DEFAULT 0, bytes INTEGER NOT NULL DEFAULT 0, "
+                "owner TEXT, message TEXT)")
+        db.execute("INSERT INTO exams (examid, status, finished, images, bytes) "
+                "VALUES ('3000', 'done', '2016-01-01T00:00:00', 10, 5000)")
+        db.commit()
+        schema = db.execute("SELECT sql FROM sqlite_master").fetchall()
+        db.close()
+
+        assert command_line._past_pulls(arguments).bytes_per_image() == 500
+        command_line.pull_exams(arguments)
+        assert sqlite3.connect(path).execute(
+                "SELECT sql FROM sqlite_master").fetchall() == schema
+    finally: 
+        shutil.rmtree(root)
+
+def test_exam_sizes_asks_only_for_the_exams_given(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments  = setup_batch(root)
+        connection = command_line._get_scanner_connection(arguments)
+        sizes = command_line._exam_sizes(connection, 
+                ["3806", "3807", "3808", "60001", "3809"])
+        assert dict(sizes) == { "3806" : 4, "3807" : 2, "3808" : 2, "60001" : 1 }
+    finally: 
+        shutil.rmtree(root)
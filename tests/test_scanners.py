@@ -0,0 +1,111 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import command_line, scanners
+import synthetic
+import logging
+import os
+import shutil
+import StringIO
+import tempfile
+
+CONFIG = """
+[north]
+port          = 4006
+aet           = {aet1}
+return_port   = {port1}
+inprocess_dir = {root}/north
+limits        = 00:00-23:59=2,23:59-00:00=2
+
+[south]
+aet           = {aet2}
+return_port   = {port2}
+inprocess_dir = {root}/south
+pfile_dir     = {root}/south-pfiles
+"""
+
+def setup_scanners(root): 
+    archive = os.path.join(root, "scanner")
+    synthetic.make_exam(archive, 3806, series = 2, images = 2)
+    synthetic.make_exam(archive, 3807, series = 1, images = 1)
+    port1, port2 = synthetic.free_port(), synthetic.free_port()
+    synthetic.use_standins(archive, "mrsrv1", port1)
+    os.environ["MRITOOL_STANDIN_DESTINATIONS"] = \
+        "mrsrv1=127.0.0.1:{},mrsrv2=127.0.0.1:{}".format(port1, port2)
+
+    path = os.path.join(root, "scanners.cfg")
+    open(path, "w").write(CONFIG.format(root = root, aet1 = "mrsrv1", 
+        aet2 = "mrsrv2", port1 = port1, port2 = port2))
+    arguments = synthetic.arguments_for(root, port1, "mrsrv1", 
+            **{ '--scanners' : path })
+    for folder in ["north", "south", "south-pfiles", "pfiles", "logs"]: 
+        os.makedirs(os.path.join(root, folder))
+    return arguments
+
+def test_read_scanners(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments  = setup_scanners(root)
+        configured = scanners.read_scanners(arguments['--scanners'], arguments)
+        assert [name for name, settings in configured] == ["north", "south"]
+        north, south = [settings for name, settings in configured]
+        assert north['--port'] == "4006" and north['--aet'] == "mrsrv1"
+        assert south['--aet'] == "mrsrv2"
+        assert south['--pfile-dir'] == os.path.join(root, "south-pfiles")
+        assert north['--pfile-dir'] == arguments['--pfile-dir']
+        assert south['--log-dir'] == os.path.join(root, "logs", "south")
+        assert south['--scanners'] is None
+
+        open(arguments['--scanners'], "a").write("[east]\nreturn_port = {}\n".format(
+            north['--return-port']))
+        try: 
+            scanners.read_scanners(arguments['--scanners'], arguments)
+            assert False, "expected a ConfigError"
+        except scanners.ConfigError: 
+            pass
+    finally: 
+        shutil.rmtree(root)
+
+def test_sync_and_list_every_scanner(): 
+    root = tempfile.mkdtemp()
+    output = StringIO.StringIO()
+    handler = logging.StreamHandler(output)
+    logger = logging.getLogger("mritool")
+    level = logger.level
+    try: 
+        arguments = setup_scanners(root)
+        command_line.sync(arguments)
+        for scanner in ["north", "south"]: 
+            assert sorted(os.listdir(os.path.join(root, scanner))) == [
+                    "20160615_Ex03806_SPN01_P3806", "20160615_Ex03807_SPN01_P3807"]
+            assert os.path.exists(os.path.join(root, "logs", scanner, "exams.db"))
+
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        command_line.list_exams(arguments)
+        listing = output.getvalue()
+        assert "Scanner" in listing
+        assert listing.count("north") == 2 and listing.count("south") == 2
+    finally: 
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+        shutil.rmtree(root)
+
+def test_exams_txt_is_imported_by_its_scanner(): 
+    root = tempfile.mkdtemp()
+    try: 
+        arguments = setup_scanners(root)
+        exams_txt = os.path.join(root, "logs", "exams.txt")
+        open(exams_txt, "w").write("3806\n")
+
+        configured = dict(scanners.read_scanners(arguments['--scanners'], 
+            dict(arguments, **{ '--aet' : "mrsrv2" })))
+        assert configured["south"]['--exams-txt'] == exams_txt
+        assert '--exams-txt' not in configured["north"]
+
+        # none has the command line's port, so the first scanner imports it
+        command_line.sync(arguments)
+        assert os.listdir(os.path.join(root, "north")) == [
+                "20160615_Ex03807_SPN01_P3807"]
+        assert sorted(os.listdir(os.path.join(root, "south"))) == [
+                "20160615_Ex03806_SPN01_P3806", "20160615_Ex03807_SPN01_P3807"]
+    finally: 
+        shutil.rmtree(root)
@@ -0,0 +1,63 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import schedule
+import datetime
+import threading
+import time
+
+def test_parse_limits(): 
+    limits = schedule.parse_limits("07:00-19:00=1,19:00-07:00=4")
+    assert limits == [(datetime.time(7), datetime.time(19), 1), 
+                      (datetime.time(19), datetime.time(7), 4)]
+    scheduler = schedule.Scheduler(limits)
+    assert scheduler.jobs(datetime.datetime(2016, 6, 15, 12)) == 1
+    assert scheduler.jobs(datetime.datetime(2016, 6, 15, 23)) == 4
+    assert scheduler.jobs(datetime.datetime(2016, 6, 15, 3)) == 4
+    assert scheduler.max_jobs() == 4
+
+    try: 
+        schedule.parse_limits("nights=4")
+        assert False, "expected a ScheduleError"
+    except schedule.ScheduleError: 
+        pass
+
+def test_order_exams(): 
+    exams = [ {"StudyID" : "10", "StudyDate" : "20160101", "StudyDescription" : "SPN01"}, 
+              {"StudyID" : "11", "StudyDate" : "20160301", "StudyDescription" : "e+1 PAC02"}, 
+              {"StudyID" : "12", "StudyDate" : "20160201", "StudyDescription" : "SPN02"} ]
+    ids = lambda exams: [exam["StudyID"] for exam in exams]
+
+    assert ids(schedule.order_exams(exams, "scanner")) == ["10", "11", "12"]
+    assert ids(schedule.order_exams(exams, "newest")) == ["11", "12", "10"]
+    assert ids(schedule.order_exams(exams, "smallest", 
+        {"10" : 500, "11" : 20, "12" : 100})) == ["11", "12", "10"]
+    assert ids(schedule.order_exams(exams, "booking:PAC*,SPN02")) == ["11", "12", "10"]
+
+def test_fit_space(): 
+    exams = [ {"StudyID" : "10"}, {"StudyID" : "11"}, {"StudyID" : "12"} ]
+    sizes = { "10" : 600, "11" : 500, "12" : 300 }
+    fits, left = schedule.fit_space(exams, sizes, 1000)
+    assert [e["StudyID"] for e in fits] == ["10", "12"]
+    assert [e["StudyID"] for e in left] == ["11"]
+    assert schedule.estimate_bytes(10) == 10 * schedule.IMAGE_BYTES
+    assert schedule.estimate_bytes(10, 2048) == 20480
+
+def test_scheduler_respects_limit(): 
+    scheduler = schedule.Scheduler([], default_jobs = 2, poll = 0.1)
+    lock      = threading.Lock()
+    running   = [0, 0]    # now, most at once
+    def work(item): 
+        with lock: 
+            running[0] += 1
+            running[1]  = max(running)
+        time.sleep(0.05)
+        with lock: 
+            running[0] -= 1
+
+    done = []
+    assert scheduler.run(range(6), work, lambda item, queued: done.append(item)) == []
+    assert sorted(done) == range(6)
+    assert running[1] == 2
+
+def test_scheduler_pauses(): 
+    scheduler = schedule.Scheduler([], default_jobs = 0, poll = 0.1)
+    assert scheduler.run(range(3), lambda item: None) == [0, 1, 2]
@@ -0,0 +1,77 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import scu
+import synthetic
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+def test_find_async_yields_responses_as_they_arrive(): 
+    root = tempfile.mkdtemp()
+    try: 
+        archive = os.path.join(root, "scanner")
+        for examid in (3806, 3807, 3808): 
+            synthetic.make_exam(archive, examid)
+        synthetic.use_standins(archive, "mrsrv1", synthetic.free_port())
+        connection = scu.SCU("127.0.0.1", 4006, 4006, "mrsrv1", "CAMHMR")
+
+        finds = [ connection.find_async(scu.StudyQuery(StudyID = examid)) 
+                  for examid in ("3806", "3807") ]
+        assert [ [r["StudyID"] for r in find.result()] for find in finds ] == [ 
+                ["3806"], ["3807"] ]
+
+        find = connection.find_async(scu.StudyQuery(StudyID = ""))
+        assert sorted(response.StudyID for response in find) == [ 
+                "3806", "3807", "3808"]
+    finally: 
+        shutil.rmtree(root)
+
+def test_move_async_reports_progress(): 
+    root = tempfile.mkdtemp()
+    try: 
+        archive = os.path.join(root, "scanner")
+        synthetic.make_exam(archive, 3806, images = 3)
+        port = synthetic.free_port()
+        synthetic.use_standins(archive, "mrsrv1", port)
+
+        # a storage SCP that takes anything sent
+        server = socket.socket()
+        server.bind(("127.0.0.1", port))
+        server.listen(1)
+        def accept(): 
+            conn, _ = server.accept()
+            stream = conn.makefile("rw")
+            for line in iter(stream.readline, ""): 
+                stream.write("stored\n")
+                stream.flush()
+        threading.Thread(target = accept).start()
+
+        progress   = []
+        connection = scu.SCU("127.0.0.1", 4006, port, "mrsrv1", "CAMHMR")
+        move = connection.move_async(scu.StudyQuery(StudyID = "3806"), 
+                dest_aet = "mrsrv1", 
+                on_progress = lambda done, left: progress.append((done, left)))
+        assert move.result() == 3
+        assert progress == [(1, 2), (2, 1), (3, 0)]
+        server.close()
+    finally: 
+        shutil.rmtree(root)
+
+def test_operations_can_be_cancelled_or_time_out(): 
+    operation = scu.Operation("sleep 10").start()
+    operation.cancel()
+    try: 
+        operation.result(5)
+        assert False, "expected OperationCancelled"
+    except scu.OperationTimeout: 
+        assert False, "expected OperationCancelled, not a timeout"
+    except scu.OperationCancelled: 
+        pass
+
+    operation = scu.Operation("sleep 10", timeout = 0.2).start()
+    try: 
+        operation.result(5)
+        assert False, "expected OperationTimeout"
+    except scu.OperationTimeout: 
+        assert operation.done()
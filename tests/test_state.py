@@ -0,0 +1,133 @@
+# vim: expandtab ts=4 sw=4 tw=80: 
+from mritool import state
+import datetime
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+def setup_store(): 
+    root = tempfile.mkdtemp()
+    return root, state.StateStore(os.path.join(root, "exams.db"))
+
+def test_import_exams_txt_once(): 
+    root, store = setup_store()
+    try: 
+        path = os.path.join(root, "exams.txt")
+        open(path, "w").write("3806\n3807\n\n")
+        assert store.import_exams_txt(path) == 2
+        assert store.with_status(state.DONE) == set(["3806", "3807"])
+
+        open(path, "a").write("3808\n")
+        assert store.import_exams_txt(path) == 0
+        assert store.status("3808") is None
+    finally: 
+        shutil.rmtree(root)
+
+def test_claim_is_exclusive(): 
+    root, store = setup_store()
+    try: 
+        other = state.StateStore(store.path)
+        other.owner = "{}:{}".format(socket.gethostname(), os.getppid())
+        assert other.claim("3806")
+        assert not store.claim("3806")
+        other.finish("3806", images = 10, bytes = 1024)
+        assert not store.claim("3806")
+        assert store.get("3806")["images"] == 10
+    finally: 
+        shutil.rmtree(root)
+
+def test_claim_resumes_when_owner_is_gone(): 
+    root, store = setup_store()
+    try: 
+        process = subprocess.Popen(["true"])
+        process.wait()
+        other = state.StateStore(store.path)
+        other.owner = "{}:{}".format(socket.gethostname(), process.pid)
+        assert other.claim("3806")
+        assert store.claim("3806")
+        assert store.get("3806")["owner"] == store.owner
+    finally: 
+        shutil.rmtree(root)
+
+def test_failed_exams_can_be_claimed_again(): 
+    root, store = setup_store()
+    try: 
+        assert store.claim("3806")
+        store.fail("3806", "Dicom transfer failed")
+        assert store.status("3806") == state.FAILED
+        assert store.claim("3806")
+    finally: 
+        shutil.rmtree(root)
+
+def test_leases_expire_unless_renewed(): 
+    root, store = setup_store()
+    try: 
+        store.lease = 0.3
+        other = state.StateStore(store.path, lease = 0.3)
+        other.owner = "otherhost:1234"
+        assert other.claim("3806")
+        assert not store.claim("3806")
+
+        with other.heartbeat("3806") as heartbeat: 
+            time.sleep(0.5)
+            assert not store.claim("3806")
+        assert not heartbeat.lost
+
+        time.sleep(0.4)
+        assert store.claim("3806")
+        assert not other.renew("3806")
+        assert store.get("3806")["owner"] == store.owner
+    finally: 
+        shutil.rmtree(root)
+
+def test_bytes_per_image_of_past_pulls(): 
+    root, store = setup_store()
+    try: 
+        assert store.bytes_per_image() is None
+        for examid, images, size in [("3806", 10, 5000), ("3807", 30, 35000)]: 
+            assert store.claim(examid)
+            store.finish(examid, images = images, bytes = size)
+        assert store.claim("3808")
+        store.fail("3808")
+        assert store.bytes_per_image() == 1000
+    finally: 
+        shutil.rmtree(root)
+
+def test_only_the_owner_ends_a_claim(): 
+    root, store = setup_store()
+    try: 
+        store.lease = 0
+        assert store.claim("3806")
+        other = state.StateStore(store.path)
+        other.owner = "otherhost:1234"
+        assert other.claim("3806")      # our lease has expired
+
+        assert not store.finish("3806", images = 10, bytes = 1024)
+        record = store.get("3806")
+        assert record["status"] == state.PULLING
+        assert record["owner"] == "otherhost:1234"
+        assert other.finish("3806", images = 10, bytes = 1024)
+        assert store.get("3806")["status"] == state.DONE
+    finally: 
+        shutil.rmtree(root)
+
+def test_leases_are_kept_in_utc(): 
+    root, store = setup_store()
+    tz = os.environ.get("TZ")
+    os.environ["TZ"] = "America/Toronto"
+    time.tzset()
+    try: 
+        assert store.claim("3806")
+        expires = state.parse_time(store.get("3806")["lease"])
+        left = expires - datetime.datetime.utcnow()
+        assert 0 < left.total_seconds() <= state.LEASE
+    finally: 
+        if tz is None: 
+            del os.environ["TZ"]
+        else: 
+            os.environ["TZ"] = tz
+        time.tzset()
+        shutil.rmtree(root)